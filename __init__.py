@@ -15,12 +15,17 @@ if "bpy" in locals():
 
     importlib.reload(operator_import)
     importlib.reload(operator_export)
+    importlib.reload(operator_lod)
     importlib.reload(options)
-    importlib.reload(face_info)
     importlib.reload(filesystem)
     importlib.reload(helpers)
     importlib.reload(ldraw_export)
     importlib.reload(ldraw_file)
+    importlib.reload(parse_cache)
+    importlib.reload(prefetch)
+    importlib.reload(parse_worker)
+    importlib.reload(session_cache)
+    importlib.reload(hidden_faces)
     importlib.reload(ldraw_node)
     importlib.reload(ldraw_geometry)
     importlib.reload(ldraw_import)
@@ -31,25 +36,35 @@ if "bpy" in locals():
     importlib.reload(matrices)
     importlib.reload(special_bricks)
 else:
-    from . import operator_import
-    from . import operator_export
-    from . import options
-    from . import face_info
-    from . import filesystem
-    from . import helpers
-    from . import ldraw_export
-    from . import ldraw_file
-    from . import ldraw_node
-    from . import ldraw_geometry
-    from . import ldraw_import
-    from . import ldraw_colors
-    from . import ldraw_camera
-    from . import ldraw_part_types
-    from . import blender_materials
-    from . import matrices
-    from . import special_bricks
-
-import bpy
+    try:
+        import bpy
+    except ImportError:
+        # the parse worker processes of prefetch import parse_worker through this package, and they run without bpy
+        bpy = None
+
+    if bpy is not None:
+        from . import operator_import
+        from . import operator_export
+        from . import operator_lod
+        from . import options
+        from . import filesystem
+        from . import helpers
+        from . import ldraw_export
+        from . import ldraw_file
+        from . import parse_cache
+        from . import prefetch
+        from . import parse_worker
+        from . import session_cache
+        from . import hidden_faces
+        from . import ldraw_node
+        from . import ldraw_geometry
+        from . import ldraw_import
+        from . import ldraw_colors
+        from . import ldraw_camera
+        from . import ldraw_part_types
+        from . import blender_materials
+        from . import matrices
+        from . import special_bricks
 
 
 def build_import_menu(self, context):
@@ -60,6 +75,10 @@ def build_export_menu(self, context):
     self.layout.operator(operator_export.EXPORT_OT_do_ldraw_export.bl_idname, text="LDraw (.mpd/.ldr/.l3b/.dat)")
 
 
+def build_object_menu(self, context):
+    self.layout.operator(operator_lod.OBJECT_OT_ldraw_assign_lod.bl_idname)
+
+
 def register():
     bpy.utils.register_class(operator_import.IMPORT_OT_do_ldraw_import)
     bpy.types.TOPBAR_MT_file_import.append(build_import_menu)
@@ -67,6 +86,9 @@ def register():
     bpy.utils.register_class(operator_export.EXPORT_OT_do_ldraw_export)
     bpy.types.TOPBAR_MT_file_export.append(build_export_menu)
 
+    bpy.utils.register_class(operator_lod.OBJECT_OT_ldraw_assign_lod)
+    bpy.types.VIEW3D_MT_object.append(build_object_menu)
+
 
 def unregister():
     bpy.utils.unregister_class(operator_import.IMPORT_OT_do_ldraw_import)
@@ -75,6 +97,9 @@ def unregister():
     bpy.utils.unregister_class(operator_export.EXPORT_OT_do_ldraw_export)
     bpy.types.TOPBAR_MT_file_export.remove(build_export_menu)
 
+    bpy.utils.unregister_class(operator_lod.OBJECT_OT_ldraw_assign_lod)
+    bpy.types.VIEW3D_MT_object.remove(build_object_menu)
+
 
 if __name__ == "__main__":
     register()
@@ -0,0 +1,367 @@
+"""Times the parts of the importer that can be measured on their own, on synthetic input.
+
+    python benchmarks/benchmark_import.py
+    blender --background --python benchmarks/benchmark_import.py
+
+Parsing, geometry buffers, file reading and traversal are each timed against the implementation they replaced,
+which is copied in below, and both are checked to give the same result. Parsing in worker processes is timed
+with one worker against one per cpu. Traversal needs the modules that import bpy, so it only runs inside blender,
+everything else only needs numpy and runs with any python.
+"""
+
+import os
+import io
+import csv
+import sys
+import time
+import codecs
+import random
+import tempfile
+import importlib
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+addon_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(addon_path))
+addon = importlib.import_module(os.path.basename(addon_path))
+
+
+def addon_module(name):
+    return importlib.import_module(f"{addon.__name__}.{name}")
+
+
+# the best of repeat runs, in seconds
+def best_time(function, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def random_coordinates(count):
+    return " ".join(f"{random.uniform(-100, 100):.3f}" for _ in range(count))
+
+
+# helpers.parse_line before it was split by line type
+def csv_parse_line(line, padding=0):
+    line = line.strip().replace("\t", " ")
+    rows = list(csv.reader(io.StringIO(line), delimiter=' ', quotechar='"', skipinitialspace=True))
+
+    if len(rows) == 0:
+        return None
+
+    params = rows[0]
+
+    if len(params) == 0:
+        return None
+
+    while len(params) < padding:
+        params.append("")
+
+    return params
+
+
+# filesystem.read_file before files were mapped and decoded a chunk at a time
+def whole_read_file(filepath):
+    with open(filepath, 'rb') as file:
+        string = file.read()
+        for c in [codecs.BOM_UTF8, codecs.BOM_UTF16, codecs.BOM_UTF32]:
+            string = string.replace(c, b'')
+        return string.decode("utf-8").strip().splitlines()
+
+
+def mixed_lines(count):
+    meta_lines = [
+        '0 !LDRAW_ORG Part UPDATE 2004-01',
+        '0 Name: 3001.dat',
+        '0 !COLOUR Black CODE 0 VALUE #1B2A34 EDGE #2B4354',
+        '0 !TEXMAP START PLANAR 1 2 3 4 5 6 7 8 9 "a b.png"',
+        '0 // "quoted ""x"" here" tail',
+        '0 BFC CERTIFY CCW',
+        '0\tSTEP',
+    ]
+
+    lines = []
+    for _ in range(count):
+        line_type = random.choice("012345")
+        if line_type == "0":
+            lines.append(random.choice(meta_lines))
+        elif line_type == "1":
+            lines.append(f"1 16 {random_coordinates(12)} s\\3001s01.dat")
+        elif line_type == "2":
+            lines.append(f"2 24 {random_coordinates(6)}")
+        elif line_type == "3":
+            lines.append(f"3 16 {random_coordinates(9)}")
+        elif line_type == "4":
+            lines.append(f"4 16  {random_coordinates(12)}  ")
+        else:
+            lines.append(f"5 24 {random_coordinates(12)}")
+    return lines
+
+
+def benchmark_parse_line():
+    helpers = addon_module("helpers")
+
+    lines = mixed_lines(200000)
+    for line in lines[:5000]:
+        assert helpers.parse_line(line, 15) == csv_parse_line(line, 15), line
+
+    for name, parse_line in [("csv", csv_parse_line), ("tokenizer", helpers.parse_line)]:
+        def parse():
+            for line in lines:
+                parse_line(line, 15)
+
+        seconds = best_time(parse, repeat=3)
+        print(f"parse_line {name}: {len(lines) / seconds:,.0f} lines/s")
+
+
+def benchmark_geometry():
+    parse_worker = addon_module("parse_worker")
+
+    lines = []
+    for i in range(20000):
+        vertex_count = random.choice([3, 4])
+        lines.append(f"{vertex_count} 16 {random_coordinates(vertex_count * 3)}")
+        if i % 3 == 0:
+            lines.append(f"2 24 {random_coordinates(6)}")
+
+    seconds = best_time(lambda: parse_worker.parse_lines("part.dat", lines), repeat=3)
+    entry = parse_worker.parse_lines("part.dat", lines)
+    array_bytes = sum(array.nbytes for array in entry["arrays"].values())
+    print(f"geometry parse and finalize: {len(lines) / seconds:,.0f} lines/s, {array_bytes / 1e6:.1f} MB of arrays")
+
+    # what one python object per vertex keeps alive for the same faces and edges
+    tracemalloc.start()
+    vertices = []
+    for line in lines:
+        values = [float(v) for v in line.split()[2:]]
+        vertices.extend(tuple(values[i:i + 3]) for i in range(0, len(values), 3))
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(vertices) == len(entry["arrays"]["vertices"]) + len(entry["arrays"]["edge_vertices"])
+    print(f"geometry as a tuple per vertex: {retained / 1e6:.1f} MB")
+
+
+def benchmark_read_file():
+    filesystem = addon_module("filesystem")
+
+    lines = []
+    for i in range(600000):
+        if i % 3 == 0:
+            lines.append("1 4 0 0 0 1 0 0 0 1 0 0 0 1 3001.dat")
+        else:
+            lines.append(f"3 16 {random.random():f} {i} 2.5 1 2 3 4 5 6")
+    data = (codecs.BOM_UTF8.decode("utf-8") + "\r\n".join(lines) + "\r\n").encode("utf-8")
+
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "big.ldr")
+        with open(filepath, 'wb') as file:
+            file.write(data)
+
+        file_lines = filesystem.read_file(filepath)
+        assert list(file_lines) == whole_read_file(filepath)
+        del file_lines
+
+        for name, read_file in [("whole file", whole_read_file), ("mapped", filesystem.read_file)]:
+            def count_lines():
+                return sum(1 for _ in read_file(filepath))
+
+            seconds = best_time(count_lines, repeat=3)
+
+            # traced separately, tracing slows down allocation
+            tracemalloc.start()
+            count_lines()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"read_file {name}: {len(data) / 1e6:.1f} MB in {seconds:.3f} s, {peak / 1e6:.1f} MB peak")
+
+
+def benchmark_parse_processes():
+    filesystem = addon_module("filesystem")
+    parse_worker = addon_module("parse_worker")
+
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = []
+        filepaths = []
+        for i in range(200):
+            filename = f"part{i}.dat"
+            lines = [f"0 Name: {filename}", "0 !LDRAW_ORG Part UPDATE 2004-01", "0 BFC CERTIFY CCW"]
+            for j in range(2000):
+                vertex_count = random.choice([3, 4])
+                lines.append(f"{vertex_count} 16 {random_coordinates(vertex_count * 3)}")
+                if j % 50 == 0:
+                    lines.append(f"1 16 {random_coordinates(12)} s\\part{i}s{j}.dat")
+            filepath = os.path.join(directory, filename)
+            with open(filepath, 'w') as file:
+                file.write("\n".join(lines))
+            filenames.append(filename)
+            filepaths.append(filepath)
+
+        expected = parse_worker.parse_lines(filenames[0], filesystem.read_file(filepaths[0]))
+
+        for worker_count in [1, max(os.cpu_count() or 1, 2)]:
+            with ProcessPoolExecutor(max_workers=worker_count, mp_context=parse_worker.WorkerContext()) as pool:
+                # the first pass starts the workers
+                entries = list(pool.map(parse_worker.parse_file, filenames, filepaths))
+                assert entries[0]["child_references"] == expected["child_references"]
+                assert np.array_equal(entries[0]["arrays"]["vertices"], expected["arrays"]["vertices"])
+
+                seconds = best_time(lambda: list(pool.map(parse_worker.parse_file, filenames, filepaths)), repeat=3)
+            print(f"parse with max_workers={worker_count}: {len(filenames) / seconds:,.0f} files/s")
+
+
+# ldraw_node.count_geometry and get_subtree before the traversal used an explicit stack, one call per level of nesting
+# without the stud, logo and color handling, which the synthetic files below don't use
+def recursive_count_geometry(counts, ldraw_file):
+    if ldraw_file in counts:
+        return counts[ldraw_file]
+
+    geometry = ldraw_file.geometry
+    vertex_count = len(geometry.vertices)
+    face_count = len(geometry.faces)
+    edge_vertex_count = len(geometry.edge_vertices)
+    edge_count = len(geometry.edges)
+
+    for child in ldraw_file.child_nodes:
+        child_counts = recursive_count_geometry(counts, child.file)
+        vertex_count += child_counts[0]
+        face_count += child_counts[1]
+        edge_vertex_count += child_counts[2]
+        edge_count += child_counts[3]
+
+    counts[ldraw_file] = (vertex_count, face_count, edge_vertex_count, edge_count)
+    return counts[ldraw_file]
+
+
+def recursive_get_subtree(subtrees, counts, ldraw_file):
+    subtree = subtrees.get(ldraw_file)
+    if subtree is not None:
+        return subtree
+
+    subtree = addon_module("ldraw_geometry").LDrawGeometry()
+    subtree.allocate(*recursive_count_geometry(counts, ldraw_file))
+    subtree.append(ldraw_file.geometry, np.identity(4), 16, use_edge_color=False, grain_slope_allowed=True)
+    subtree.append_edges(ldraw_file.geometry, np.identity(4))
+
+    for child in ldraw_file.child_nodes:
+        child_subtree = recursive_get_subtree(subtrees, counts, child.file)
+        subtree.append_subtree(child_subtree, child.matrix, 16)
+        subtree.append_edges(child_subtree, child.matrix)
+
+    subtrees[ldraw_file] = subtree
+    return subtree
+
+
+def benchmark_traversal():
+    mathutils = importlib.import_module("mathutils")
+    options = addon_module("options")
+    matrices = addon_module("matrices")
+    ldraw_node = addon_module("ldraw_node")
+    ldraw_file = addon_module("ldraw_file")
+    LDrawGeometry = addon_module("ldraw_geometry").LDrawGeometry
+
+    options.capture_fingerprint()
+
+    def create_file(name, part_type, face_count):
+        file = ldraw_file.LDrawFile(name)
+        file.name = name
+        file.part_type = part_type
+        geometry = file.geometry
+        geometry.vertices = np.random.random((face_count * 3, 3))
+        geometry.faces = np.full(face_count, 3, dtype=np.int32)
+        geometry.face_color_codes = np.full(face_count, 16, dtype=np.int32)
+        geometry.face_use_edge_color = np.zeros(face_count, dtype=bool)
+        geometry.face_grain_slope_allowed = np.ones(face_count, dtype=bool)
+        return file
+
+    def translation(x, y, z):
+        return mathutils.Matrix((
+            (1.0, 0.0, 0.0, x),
+            (0.0, 1.0, 0.0, y),
+            (0.0, 0.0, 1.0, z),
+            (0.0, 0.0, 0.0, 1.0)
+        ))
+
+    # the deeper chain is past the recursion limit, which recursive flattening runs into
+    for depth in [500, 5000]:
+        files = [create_file(f"chain{i}.dat", "subpart", 1) for i in range(depth)]
+        for file, child in zip(files, files[1:]):
+            file.child_nodes = [ldraw_node.LDrawNode(child, "16", translation(0.0, 1.0, 0.0))]
+
+        def flatten_chain_recursive():
+            return recursive_get_subtree({}, {}, files[0])
+
+        def flatten_chain():
+            ldraw_node.reset_caches()
+            return ldraw_node.get_subtree(files[0], "16", False, False)
+
+        try:
+            seconds = best_time(flatten_chain_recursive)
+            assert np.array_equal(flatten_chain_recursive().vertices, flatten_chain().vertices)
+            print(f"traversal of a {depth} level chain, recursive: {seconds:.3f} s")
+        except RecursionError:
+            print(f"traversal of a {depth} level chain, recursive: RecursionError")
+
+        seconds = best_time(flatten_chain)
+        assert len(flatten_chain().faces) == depth
+        print(f"traversal of a {depth} level chain, explicit stack: {seconds:.3f} s")
+
+    stud = create_file("stud.dat", "primitive", 32)
+    parts = []
+    for i in range(20):
+        part = create_file(f"part{i}.dat", "part", 10)
+        part.child_nodes = [ldraw_node.LDrawNode(stud, "16", translation(x * 20.0, 0.0, z * 20.0)) for x in range(32) for z in range(32)]
+        parts.append(part)
+
+    # each stud was its own call of LDrawNode.load, which appended its subtree
+    def flatten_parts_recursive():
+        subtrees = {}
+        counts = {}
+        flattened = []
+        for part in parts:
+            geometry = LDrawGeometry()
+            geometry.allocate(*recursive_count_geometry(counts, part))
+            geometry.append(part.geometry, matrices.identity, 16, use_edge_color=False, grain_slope_allowed=True)
+            for child in part.child_nodes:
+                subtree = recursive_get_subtree(subtrees, counts, child.file)
+                geometry.append_subtree(subtree, child.matrix, 16)
+                geometry.append_edges(subtree, child.matrix)
+            flattened.append(geometry)
+        return flattened
+
+    def flatten_parts():
+        ldraw_node.reset_caches()
+        flattened = []
+        for part in parts:
+            geometry = LDrawGeometry()
+            geometry.allocate(*ldraw_node.count_geometry(part))
+            geometry.append(part.geometry, matrices.identity, 16, use_edge_color=False, grain_slope_allowed=True)
+            ldraw_node.append_child_subtrees(geometry, part, matrices.identity, "16", False, False)
+            flattened.append(geometry)
+        return flattened
+
+    for expected, geometry in zip(flatten_parts_recursive(), flatten_parts()):
+        assert np.allclose(expected.vertices, geometry.vertices)
+
+    for name, flatten in [("recursive", flatten_parts_recursive), ("explicit stack", flatten_parts)]:
+        seconds = best_time(flatten)
+        print(f"traversal of {len(parts)} parts with 1024 studs each, {name}: {seconds:.3f} s")
+
+
+if __name__ == "__main__":
+    random.seed(1)
+    np.random.seed(1)
+
+    benchmark_parse_line()
+    benchmark_geometry()
+    benchmark_read_file()
+    benchmark_parse_processes()
+
+    if addon.bpy is None:
+        print("traversal: skipped, run inside blender")
+    else:
+        benchmark_traversal()
@@ -39,6 +39,16 @@ def create_ldraw_materials():
 
 
 def get_material(color, use_edge_color=False, is_slope_material=False):
+    key = material_name(color, use_edge_color=use_edge_color, is_slope_material=is_slope_material)
+
+    if key in bpy.data.materials:
+        return bpy.data.materials[key]
+
+    material = __create_node_based_material(key, color, use_edge_color=use_edge_color, is_slope_material=is_slope_material)
+    return material
+
+
+def material_name(color, use_edge_color=False, is_slope_material=False):
     key = []
     key.append("LDraw Material")
     key.append(color.code)
@@ -56,13 +66,7 @@ def get_material(color, use_edge_color=False, is_slope_material=False):
     suffix = "_".join([k.lower() for k in suffix])
 
     key.append(suffix)
-    key = " ".join(key)
-
-    if key in bpy.data.materials:
-        return bpy.data.materials[key]
-
-    material = __create_node_based_material(key, color, use_edge_color=use_edge_color, is_slope_material=is_slope_material)
-    return material
+    return " ".join(key)
 
 
 def __create_node_based_material(key, color, use_edge_color=False, is_slope_material=False):
@@ -1,17 +1,37 @@
 import os
+import mmap
 import codecs
 import string
+import tempfile
 from sys import platform
 from pathlib import Path
 
 from . import options
 
 search_paths = []
+locate_cache = {}
+
+# lowercase name relative to a search path => absolute path, for every file under the search paths
+# the first search path that has a name wins, same as probing them in order
+# directory_listings survives between imports so the library only has to be walked once
+# after that only directories whose mtime changed are listed again
+library_index = {}
+library_index_key = None
+directory_listings = {}
+directory_listings_version = 0
+
+# files at least this big are memory mapped instead of read
+mmap_threshold = 64 * 1024
+
+# bytes of a file that are decoded at once while its lines are iterated
+read_chunk_size = 1024 * 1024
 
 
 def reset_caches():
     global search_paths
+    global locate_cache
     search_paths = []
+    locate_cache = {}
 
 
 def append_search_path(path):
@@ -41,6 +61,10 @@ def locate_ldraw():
     return ""
 
 
+def default_cache_path():
+    return os.path.join(tempfile.gettempdir(), "ldraw_parse_cache")
+
+
 def build_search_paths():
     reset_caches()
 
@@ -54,6 +78,8 @@ def build_search_paths():
         append_official()
         append_unofficial()
 
+    build_library_index()
+
 
 def append_official():
     append_search_path(os.path.join(options.ldraw_path, "parts"))
@@ -75,6 +101,77 @@ def append_unofficial():
     append_search_path(os.path.join(options.ldraw_path, "unofficial", "p"))
 
 
+def __list_directory(path, visited):
+    global directory_listings_version
+
+    real_path = os.path.realpath(path)
+    if real_path in visited:
+        return
+    visited.add(real_path)
+
+    key = os.path.normcase(path)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        if directory_listings.pop(key, None) is not None:
+            directory_listings_version += 1
+        return
+
+    listing = directory_listings.get(key)
+    if listing is None or listing[0] != mtime:
+        files = []
+        directories = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        directories.append(entry.name)
+                    else:
+                        files.append(entry.name)
+        except OSError:
+            return
+        listing = (mtime, files, directories)
+        directory_listings[key] = listing
+        directory_listings_version += 1
+
+    for directory in listing[2]:
+        __list_directory(os.path.join(path, directory), visited)
+
+
+def __index_directory(index, path, relative_path):
+    listing = directory_listings.get(os.path.normcase(path))
+    if listing is None:
+        return
+
+    for filename in listing[1]:
+        key = f"{relative_path}{filename}".lower()
+        if key not in index:
+            index[key] = os.path.join(path, filename)
+
+    for directory in listing[2]:
+        __index_directory(index, os.path.join(path, directory), f"{relative_path}{directory}/")
+
+
+def build_library_index():
+    global library_index
+    global library_index_key
+
+    visited = set()
+    for path in search_paths:
+        __list_directory(path, visited)
+
+    key = (tuple(search_paths), directory_listings_version)
+    if key == library_index_key:
+        return
+
+    index = {}
+    for path in search_paths:
+        __index_directory(index, path, "")
+
+    library_index = index
+    library_index_key = key
+
+
 # https://stackoverflow.com/a/8462613
 def path_insensitive(path):
     """
@@ -146,28 +243,98 @@ def _path_insensitive(path):
 
 def read_file(filepath):
     filepath = path_insensitive(filepath)
+    return FileLines(map_file(filepath))
+
+
+# the lines of data[start:end], decoded a chunk at a time while they are iterated
+# iterating again starts over from the beginning, nothing decoded is kept
+# data is anything map_file returns, a chunk ends at a line break and is decoded without copying it first
+# a chunk that isn't valid utf-8 is decoded as latin-1, which many older library files are written in
+class FileLines:
+    def __init__(self, data, start=0, end=None):
+        if end is None:
+            end = len(data)
+
+        for bom in [codecs.BOM_UTF8, codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE]:
+            if data[start:start + len(bom)] == bom:
+                start += len(bom)
+                break
+
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def __bool__(self):
+        return self.end > self.start
+
+    def __iter__(self):
+        data = self.data
+        position = self.start
+        end = self.end
+        with memoryview(data) as view:
+            while position < end:
+                chunk_end = min(position + read_chunk_size, end)
+                if chunk_end < end:
+                    line_end = data.rfind(b"\n", position, chunk_end)
+                    if line_end < 0:
+                        line_end = data.find(b"\n", chunk_end, end)
+                    if line_end >= 0:
+                        chunk_end = line_end + 1
+                    else:
+                        chunk_end = end
+
+                chunk = view[position:chunk_end]
+                try:
+                    text = str(chunk, "utf-8")
+                except UnicodeDecodeError:
+                    text = str(chunk, "latin-1")
+                chunk.release()
+
+                yield from text.splitlines()
+                position = chunk_end
+
+
+# returns something that supports the buffer protocol
+# small files are just read, the mapping of a big file stays valid for as long as anything references it
+# on windows a mapped file can't be replaced, so nothing that outlives an import should keep one
+def map_file(filepath):
     with open(filepath, 'rb') as file:
-        string = file.read()
-        for c in [codecs.BOM_UTF8, codecs.BOM_UTF16, codecs.BOM_UTF32]:
-            string = string.replace(c, b'')
-        # print(string)
-        return string.decode("utf-8").strip().splitlines()
+        size = os.fstat(file.fileno()).st_size
+        if size < mmap_threshold:
+            return file.read()
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
 
 
+# results, including misses, are kept until the search paths change
 def locate(filename):
+    if filename in locate_cache:
+        return locate_cache[filename]
+
+    full_path = __locate(filename)
+    locate_cache[filename] = full_path
+    return full_path
+
+
+def __locate(filename):
     part_path = filename.replace("\\", os.path.sep)
     part_path = os.path.expanduser(part_path)
 
+    # a path relative to anything in search_paths
+    if not os.path.isabs(part_path):
+        full_path = library_index.get(part_path.replace(os.path.sep, "/").lower())
+        if full_path is not None:
+            return full_path
+
     # full path was specified
     if os.path.exists(part_path):
         return part_path
 
     # ldraw spec says to search in the current file's directory
-    # a path relative to anything in search_paths
+    # anything under search_paths is already in library_index
     filename_folder = os.path.dirname(part_path)
     file_search_paths = [filename_folder]
 
-    for path in search_paths + file_search_paths:
+    for path in file_search_paths:
         full_path = os.path.join(path, part_path)
         if options.debug_text:
             print(full_path)
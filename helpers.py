@@ -1,15 +1,25 @@
-import csv
-import io
+def parse_line(line, padding=0):
+    """Split an LDraw line into its fields.
 
+    Line types 1-5 are plain whitespace separated values, except for the trailing filename of a type 1 line
+    which may contain spaces and may be wrapped in quotes. It is returned whole as params[14].
+    Only meta lines that actually contain a quote go through the slower quote aware splitter.
+    """
 
-def parse_line(line, padding=0):
-    line = line.strip().replace("\t", " ")
-    rows = list(csv.reader(io.StringIO(line), delimiter=' ', quotechar='"', skipinitialspace=True))
+    line = line.strip()
 
-    if len(rows) == 0:
+    if line == "":
         return None
 
-    params = rows[0]
+    line_type = line[0]
+    if line_type == "1":
+        params = line.split(None, 14)
+        if len(params) == 15:
+            params[14] = __unquote(params[14])
+    elif line_type == "0" and '"' in line:
+        params = __split_quoted(line)
+    else:
+        params = line.split()
 
     if len(params) == 0:
         return None
@@ -18,3 +28,95 @@ def parse_line(line, padding=0):
         params.append("")
 
     return params
+
+
+# (color_code, (x, y, z, a, b, c, d, e, f, g, h, i), filename, invert) as written in a type 1 line
+# invert is whether the line follows 0 BFC INVERTNEXT
+def parse_child_reference(params, invert=False):
+    color_code = params[1]
+    matrix_values = tuple(map(float, params[2:14]))
+
+    # parse_line keeps spaces in the filename, so params[14] is the whole filename
+    filename = params[14].lower()
+
+    return color_code, matrix_values, filename, invert
+
+
+# https://www.ldraw.org/article/415.html
+# (certified, is_cw, invert_next) after a 0 BFC line, from what they were before it
+# CLIP and NOCLIP only change how faces are culled, which doesn't matter for the winding of faces
+def parse_bfc(params, certified, is_cw, invert_next):
+    for option in params[2:]:
+        option = option.lower()
+        if option == "certify":
+            certified = True
+        elif option == "nocertify":
+            certified = False
+        elif option == "cw":
+            is_cw = True
+        elif option == "ccw":
+            is_cw = False
+        elif option == "invertnext":
+            invert_next = True
+    return certified, is_cw, invert_next
+
+
+def __unquote(value):
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+# mirrors csv.reader(delimiter=' ', quotechar='"', skipinitialspace=True)
+# a quote only opens a quoted section at the start of a field and "" inside one is a literal quote
+def __split_quoted(line):
+    params = []
+    field = []
+    in_field = False
+    in_quotes = False
+    i = 0
+    length = len(line)
+    while i < length:
+        c = line[i]
+        if in_quotes:
+            if c == '"':
+                if i + 1 < length and line[i + 1] == '"':
+                    field.append('"')
+                    i += 1
+                else:
+                    in_quotes = False
+            else:
+                field.append(c)
+        elif c.isspace():
+            if in_field:
+                params.append("".join(field))
+                field = []
+                in_field = False
+        elif c == '"' and not in_field:
+            in_field = True
+            in_quotes = True
+        else:
+            in_field = True
+            field.append(c)
+        i += 1
+
+    if in_field:
+        params.append("".join(field))
+
+    return params
+
+
+# direct colors are written as 0x2RRGGBB
+def color_code_to_int(color_code):
+    try:
+        if color_code[:2].lower() == "0x":
+            return int(color_code, 16)
+        return int(color_code)
+    except ValueError:
+        return 16
+
+
+def int_to_color_code(value):
+    if value >= 0x2000000:
+        return f"0x{value:07X}"
+    return str(value)
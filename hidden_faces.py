@@ -0,0 +1,236 @@
+"""Removes the faces of imported parts that other parts enclose, like the tops of studs inside the brick above.
+
+Only used with options.remove_hidden_faces, once the model is loaded. Parts that may touch are found through a grid
+of their bounding boxes. A face is hidden when its center and corners all lie inside the bounding box of an opaque
+neighbour and a ray cast from each of them in every direction of ray_directions hits an opaque face of the part or
+of a neighbour. The rays only sample the directions, so a face only seen through a narrow gap may be removed.
+There is one bvh tree for each mesh and set of opaque faces, in the space of the mesh, and each ray is moved into
+the space of every object it is cast against.
+Objects that lose faces get a reduced copy of their mesh, shared by the objects of that mesh that lose the same
+faces. The mesh they shared before is left as it is.
+"""
+
+import itertools
+
+import bmesh
+import numpy as np
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+
+# the directions from a cell of a cube grid to its 26 neighbours
+ray_directions = [np.array(d, dtype=np.float64) / np.linalg.norm(d) for d in itertools.product((-1, 0, 1), repeat=3) if d != (0, 0, 0)]
+
+# rays this close to parallel with a face run along it and are skipped
+min_ray_angle_cos = 0.1
+
+removed_triangles = 0
+reduced_objects = 0
+
+mesh_data = {}
+bvh_cache = {}
+
+
+def reset_caches():
+    global removed_triangles
+    global reduced_objects
+    global mesh_data
+    global bvh_cache
+
+    removed_triangles = 0
+    reduced_objects = 0
+    mesh_data = {}
+    bvh_cache = {}
+
+
+def remove_hidden_faces(objects):
+    global removed_triangles
+    global reduced_objects
+
+    parts = []
+    for obj in objects:
+        if obj.type != "MESH" or obj.instance_type != "NONE" or len(obj.data.polygons) < 1:
+            continue
+        # an object instanced by its parent, like the stud mesh below a stud carrier, doesn't show where it is placed
+        # but at every face of its parent, so it neither hides faces nor has faces hidden
+        if obj.parent is not None and obj.parent.instance_type != "NONE":
+            continue
+        parts.append(__part(obj))
+
+    if len(parts) < 2:
+        return
+
+    hidden = []
+    for part, neighbours in zip(parts, __neighbours(parts)):
+        if len(neighbours) < 1:
+            continue
+        hidden_faces = __hidden_faces(part, neighbours)
+        if len(hidden_faces) > 0:
+            hidden.append((part, hidden_faces))
+
+    # faces are only removed once every part has been tested against the geometry as it was imported
+    # objects of the same mesh that lose the same faces, like the bricks of a wall, share one reduced copy
+    reduced_meshes = {}
+    for part, hidden_faces in hidden:
+        obj = part[0]
+        key = (obj.data.name, frozenset(hidden_faces.tolist()))
+        mesh = reduced_meshes.get(key)
+        if mesh is None:
+            mesh = obj.data.copy()
+
+            bm = bmesh.new()
+            bm.from_mesh(mesh)
+            bm.faces.ensure_lookup_table()
+            bmesh.ops.delete(bm, geom=[bm.faces[i] for i in hidden_faces], context="FACES")
+            bm.to_mesh(mesh)
+            bm.clear()
+            bm.free()
+
+            reduced_meshes[key] = mesh
+
+        obj.data = mesh
+
+        totals = part[4]
+        removed_triangles += int(np.sum(totals[hidden_faces] - 2))
+        reduced_objects += 1
+
+
+# (obj, world vertices, face loop starts, loop vertex indices, face loop totals, world face normals, opaque faces, box min, box max,
+#  matrix_world)
+def __part(obj):
+    mesh = obj.data
+    data = mesh_data.get(mesh.name)
+    if data is None:
+        vertices = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", vertices)
+        loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", loop_vertices)
+        starts = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", starts)
+        totals = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_total", totals)
+        normals = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+        mesh.polygons.foreach_get("normal", normals)
+        material_indices = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("material_index", material_indices)
+        data = (vertices.reshape(-1, 3).astype(np.float64), starts, loop_vertices, totals, normals.reshape(-1, 3).astype(np.float64), material_indices)
+        mesh_data[mesh.name] = data
+
+    vertices, starts, loop_vertices, totals, normals, material_indices = data
+
+    m = np.array(obj.matrix_world, dtype=np.float64)
+    world_vertices = vertices @ m[:3, :3].T + m[:3, 3]
+    world_normals = normals @ np.linalg.inv(m[:3, :3])
+    world_normals /= np.maximum(np.linalg.norm(world_normals, axis=1), 1e-12)[:, np.newaxis]
+
+    # slots may be linked to the object, so opacity is looked up per object
+    opaque_slots = []
+    for slot in obj.material_slots:
+        material = slot.material
+        opaque_slots.append(material is not None and not material.get("LEGO.isTransparent", False))
+    opaque_slots = np.array(opaque_slots + [False], dtype=bool)
+    opaque = opaque_slots[np.minimum(material_indices, len(opaque_slots) - 1)]
+
+    return (obj, world_vertices, starts, loop_vertices, totals, world_normals, opaque,
+            world_vertices.min(axis=0), world_vertices.max(axis=0), m)
+
+
+# the opaque parts whose bounding boxes touch the bounding box of each part, found through a grid of cells
+# about the size of a typical part
+def __neighbours(parts):
+    sizes = np.array([np.max(part[8] - part[7]) for part in parts])
+    cell_size = max(float(np.median(sizes)), 1e-6)
+    tolerance = cell_size * 1e-3
+
+    grid = {}
+    cells = []
+    for i, part in enumerate(parts):
+        low = np.floor((part[7] - tolerance) / cell_size).astype(int)
+        high = np.floor((part[8] + tolerance) / cell_size).astype(int)
+        part_cells = list(itertools.product(*[range(low[axis], high[axis] + 1) for axis in range(3)]))
+        cells.append(part_cells)
+        if np.any(part[6]):
+            for cell in part_cells:
+                grid.setdefault(cell, []).append(i)
+
+    neighbours = []
+    for i, part in enumerate(parts):
+        found = set()
+        for cell in cells[i]:
+            for j in grid.get(cell, []):
+                if j == i or j in found:
+                    continue
+                other = parts[j]
+                if np.all(part[7] <= other[8] + tolerance) and np.all(other[7] <= part[8] + tolerance):
+                    found.add(j)
+        neighbours.append([parts[j] for j in sorted(found)])
+    return neighbours
+
+
+def __hidden_faces(part, neighbours):
+    world_vertices, starts, loop_vertices, totals, normals = part[1:6]
+
+    tolerance = np.max(part[8] - part[7]) * 1e-3
+    low = np.array([other[7] for other in neighbours]) - tolerance
+    high = np.array([other[8] for other in neighbours]) + tolerance
+
+    # the corners of each face pulled slightly toward its center and the center itself
+    corners = world_vertices[loop_vertices]
+    centers = np.add.reduceat(corners, starts) / totals[:, np.newaxis]
+    face_of_loop = np.repeat(np.arange(len(starts)), totals)
+    corners = corners + (centers[face_of_loop] - corners) * 1e-2
+
+    # a face can only be hidden by a neighbour when all of its points are inside a neighbour's box
+    def inside(points):
+        return np.any(np.all((points[:, np.newaxis] >= low) & (points[:, np.newaxis] <= high), axis=2), axis=1)
+
+    candidates = inside(centers)
+    corners_inside = inside(corners)
+    candidates &= np.logical_and.reduceat(corners_inside, starts)
+    candidate_faces = np.flatnonzero(candidates)
+    if len(candidate_faces) < 1:
+        return []
+
+    occluders = [__occluder(other) for other in [part] + neighbours if np.any(other[6])]
+    offset = tolerance * 1e-1
+
+    hidden_faces = []
+    for face in candidate_faces:
+        normal = normals[face]
+        points = np.concatenate([centers[face:face + 1], corners[starts[face]:starts[face] + totals[face]]])
+        if __enclosed(occluders, points, normal, offset):
+            hidden_faces.append(face)
+    return np.array(hidden_faces, dtype=np.int64)
+
+
+# (bvh tree of the opaque faces of the mesh of part in the space of the mesh, inverse of the part's matrix_world)
+def __occluder(part):
+    obj, opaque, m = part[0], part[6], part[9]
+    key = (obj.data.name, opaque.tobytes())
+    bvh = bvh_cache.get(key)
+    if bvh is None:
+        vertices, starts, loop_vertices, totals = mesh_data[obj.data.name][:4]
+        loops = loop_vertices.tolist()
+        polygons = [loops[start:start + total] for start, total in zip(starts[opaque].tolist(), totals[opaque].tolist())]
+        bvh = BVHTree.FromPolygons(vertices.tolist(), polygons)
+        bvh_cache[key] = bvh
+    return bvh, np.linalg.inv(m)
+
+
+# whether the ray from each point in each direction hits an opaque face of one of the occluders
+def __enclosed(occluders, points, normal, offset):
+    for direction in ray_directions:
+        if abs(np.dot(direction, normal)) < min_ray_angle_cos:
+            continue
+        origins = points + direction * offset
+        hit = np.zeros(len(points), dtype=bool)
+        for bvh, inverse in occluders:
+            ray_direction = Vector(inverse[:3, :3] @ direction)
+            local_origins = origins @ inverse[:3, :3].T + inverse[:3, 3]
+            for i in np.flatnonzero(~hit).tolist():
+                location, _, _, _ = bvh.ray_cast(Vector(local_origins[i]), ray_direction)
+                hit[i] = location is not None
+            if np.all(hit):
+                break
+        if not np.all(hit):
+            return False
+    return True
@@ -7,11 +7,14 @@ import struct
 from . import options
 
 colors = {}
+bad_color_codes = set()
 
 
 def reset_caches():
     global colors
+    global bad_color_codes
     colors = {}
+    bad_color_codes = set()
 
 
 def get_color(color_code):
@@ -21,7 +24,10 @@ def get_color(color_code):
     if color_code in colors:
         return colors[color_code]
 
-    print(f"Bad color code: {color_code}")
+    # reported once per import
+    if color_code not in bad_color_codes:
+        bad_color_codes.add(color_code)
+        print(f"Bad color code: {color_code}")
     color_code = "16"
     return colors[color_code]
 
@@ -64,9 +64,10 @@ def export_subfiles(obj, lines, is_model=False):
     color_code = "16"
     color = ldraw_colors.get_color(color_code)
 
-    if len(obj.data.materials) > 0:
-        material = obj.data.materials[0]
-        if strings.ldraw_color_code_key in material:
+    # material_slots so that a color set on the object instead of the shared mesh is exported
+    if len(obj.material_slots) > 0:
+        material = obj.material_slots[0].material
+        if material is not None and strings.ldraw_color_code_key in material:
             color_code = str(material[strings.ldraw_color_code_key])
             color = ldraw_colors.get_color(color_code)
 
@@ -1,6 +1,8 @@
 import os
+import codecs
 import mathutils
 import re
+import threading
 
 from . import options
 from . import filesystem
@@ -13,17 +15,91 @@ from .texmap import TexMap
 from . import special_bricks
 from . import ldraw_colors
 from . import ldraw_camera
+from . import parse_cache
+from . import prefetch
+from . import parse_worker
+from . import session_cache
 
 mpd_file_cache = {}
 file_cache = {}
 
+# memoized for the whole import, including files that could not be found
+# filepath => (file embedded in the mpd, path on disk), at most one of which is not None
+resolved_filepaths = {}
+logo_filenames = {}
+missing_files = set()
+# prefetch threads resolve files too
+resolve_lock = threading.Lock()
+
 
 def reset_caches():
     global mpd_file_cache
     global file_cache
+    global resolved_filepaths
+    global logo_filenames
+    global missing_files
 
     mpd_file_cache = {}
     file_cache = {}
+    resolved_filepaths = {}
+    logo_filenames = {}
+    missing_files = set()
+
+
+# for when the search paths change during an import
+def reset_resolved_filepaths():
+    global resolved_filepaths
+    resolved_filepaths = {}
+
+
+# called once an import is done, the mpd files keep the mpd mapped
+# and on windows a mapped file can't be saved over, so it couldn't be edited and imported again
+def release_mpd_files():
+    global mpd_file_cache
+    global resolved_filepaths
+
+    mpd_file_cache = {}
+    resolved_filepaths = {}
+
+
+# files embedded in an mpd shadow files on disk with the same name
+# two threads may locate the same file at once, only the first result is kept and reported
+def resolve_filepath(filepath):
+    resolved = resolved_filepaths.get(filepath)
+    if resolved is not None:
+        return resolved
+
+    mpd_file = mpd_file_cache.get(filepath)
+    path = None
+    if mpd_file is None:
+        # if missing, use a,b,c etc parts if available
+        # TODO: look in this file's directory and directories relative to this file's directory
+        path = filesystem.locate(filepath)
+
+    with resolve_lock:
+        resolved = resolved_filepaths.get(filepath)
+        if resolved is not None:
+            return resolved
+
+        resolved = (mpd_file, path)
+        resolved_filepaths[filepath] = resolved
+        if mpd_file is None and path is None:
+            missing_files.add(filepath)
+            print(f"missing {filepath}")
+    return resolved
+
+
+def get_logo_filename(filename):
+    if filename not in logo_filenames:
+        parts = filename.split(".")
+        name = parts[0]
+        ext = parts[1]
+        new_filename = f"{name}-{options.chosen_logo}.{ext}"
+        if filesystem.locate(new_filename):
+            logo_filenames[filename] = new_filename
+        else:
+            logo_filenames[filename] = filename
+    return logo_filenames[filename]
 
 
 def read_color_table():
@@ -42,56 +118,101 @@ def read_color_table():
     ldraw_file.parse_file()
 
 
+# streams through the file once, only looking at lines that start with 0
+# each embedded file is recorded as a byte range of the mpd and only decoded when it is read
 def handle_mpd(filepath):
-    ldraw_file = LDrawFile(filepath)
-    ldraw_file.read_file()
-
-    lines = ldraw_file.lines
-
-    if len(lines) < 1:
+    mpd_filepath = filesystem.locate(filepath)
+    if mpd_filepath is None:
         return None
 
-    if not lines[0].lower().startswith("0 f"):
-        return filepath
-
+    mpd_filepath = filesystem.path_insensitive(mpd_filepath)
+    data = None
     root_file = None
     current_file = None
-    for line in lines:
-        params = helpers.parse_line(line, 9)
+    with open(mpd_filepath, 'rb') as file:
+        offset = 0
+        first_line = True
+        for raw_line in file:
+            line_start = offset
+            offset += len(raw_line)
+
+            line = raw_line.strip()
+            if first_line:
+                if line.startswith(codecs.BOM_UTF8):
+                    line = line[len(codecs.BOM_UTF8):].strip()
+                if line == b"":
+                    continue
+                if not line.lower().startswith(b"0 f"):
+                    return filepath
+                first_line = False
+
+            if line[:1] != b"0":
+                continue
 
-        if params is None:
-            continue
+            params = line.split(None, 2)
+            if len(params) < 2 or params[0] != b"0":
+                continue
 
-        if params[0] == "0" and params[1].lower() == "file":
-            __parse_current_file(current_file)
-            current_file = LDrawFile(line[7:].lower())
+            command = params[1].lower()
+            if command == b"file":
+                __end_current_file(current_file, line_start)
+                name = b""
+                if len(params) > 2:
+                    name = params[2]
+                if data is None:
+                    data = filesystem.map_file(mpd_filepath)
+                current_file = MPDFile(__decode_name(name), data, offset)
+
+                if root_file is None:
+                    root_file = current_file.filepath
+            elif command == b"nofile":
+                __end_current_file(current_file, line_start)
+                current_file = None
+
+        __end_current_file(current_file, offset)
+
+    if first_line:
+        return None
 
-            if root_file is None:
-                root_file = line[7:].lower()
+    if root_file is not None:
+        return root_file
+    return filepath
 
-        elif params[0] == "0" and params[1].lower() == "nofile":
-            __parse_current_file(current_file)
-            current_file = None
 
-        elif current_file is not None:
-            current_file.lines.append(line)
+def __decode_name(name):
+    try:
+        name = name.decode("utf-8")
+    except UnicodeDecodeError:
+        name = name.decode("latin-1")
+    return name.strip().lower()
 
-    __parse_current_file(current_file)
 
-    if root_file is not None:
-        return root_file
-    return filepath
+def __end_current_file(mpd_file, end):
+    if mpd_file is not None:
+        mpd_file.end = end
+        mpd_file_cache[mpd_file.filepath] = mpd_file
+        resolved_filepaths.pop(mpd_file.filepath, None)
+        session_cache.mpd_filenames.add(mpd_file.filepath)
 
 
-def __parse_current_file(ldraw_file):
-    if ldraw_file is not None:
-        mpd_file_cache[ldraw_file.filepath] = ldraw_file
+# a file embedded in an mpd, its lines are decoded from its byte range of the mpd whenever they are iterated
+class MPDFile:
+    def __init__(self, filepath, data, start, end=None):
+        self.filepath = filepath
+        self.data = data
+        self.start = start
+        self.end = end
+
+    @property
+    def lines(self):
+        return filesystem.FileLines(self.data, self.start, self.end)
 
 
-def get_child_node(line, params):
-    color_code = params[1]
+def get_child_node(color_code, matrix_values, filename, invert=False):
+    if filename == "":
+        return None
 
-    (x, y, z, a, b, c, d, e, f, g, h, i) = map(float, params[2:14])
+    (x, y, z, a, b, c, d, e, f, g, h, i) = matrix_values
     matrix = mathutils.Matrix((
         (a, b, c, x),
         (d, e, f, y),
@@ -99,41 +220,24 @@ def get_child_node(line, params):
         (0, 0, 0, 1)
     ))
 
-    # there might be spaces in the filename, so don't just split on whitespace
-    # filename_args = re.search(r"(?:.*\s+){14}(.*)", line.strip())
-    # print(line.strip())
-    filename_args = re.search(r".*?\s+.*?\s+.*?\s+.*?\s+.*?\s+.*?\s+.*?\s+.*?\s+.*?\s+.*?\s+.*?\s+.*?\s+.*?\s+.*?\s+(.*)", line.strip())
-    filename = filename_args[1].lower()
-    # filename = " ".join(params[14:]).lower()
-
     if options.display_logo:
         if filename in special_bricks.studs:
-            parts = filename.split(".")
-            name = parts[0]
-            ext = parts[1]
-            new_filename = f"{name}-{options.chosen_logo}.{ext}"
-            if filesystem.locate(new_filename):
-                filename = new_filename
-
-    key = []
-    key.append(options.resolution)
-    if options.display_logo:
-        key.append(options.chosen_logo)
-    if options.remove_doubles:
-        key.append("rd")
-    key.append(color_code)
-    key.append(os.path.basename(filename))
-    key = "_".join([k.lower() for k in key])
-    key = re.sub(r"[^a-z0-9._]", "-", key)
-
-    if key not in file_cache:
-        ldraw_file = LDrawFile(filename)
-        if not ldraw_file.read_file():
-            return None
-        ldraw_file.parse_file()
+            filename = get_logo_filename(filename)
+
+    # what a file parses to doesn't depend on the color it's used in, so each file is parsed once
+    key = (options.fingerprint, filename)
+
+    ldraw_file = file_cache.get(key)
+    if ldraw_file is None:
+        ldraw_file = session_cache.get_file(key)
+        if ldraw_file is None:
+            ldraw_file = LDrawFile(filename)
+            if not ldraw_file.read_file():
+                return None
+            ldraw_file.parse_file()
+            session_cache.put_file(key, ldraw_file)
         file_cache[key] = ldraw_file
-    ldraw_file = file_cache[key]
-    ldraw_node = LDrawNode(ldraw_file, color_code=color_code, matrix=matrix)
+    ldraw_node = LDrawNode(ldraw_file, color_code=color_code, matrix=matrix, invert=invert)
 
     return ldraw_node
 
@@ -146,28 +250,58 @@ class LDrawFile:
         self.geometry = LDrawGeometry()
         self.part_type = None
         self.lines = []
-
+        self.child_references = []
+        self.source_path = None
+        self.cacheable = True
+        self.cached = False
+        # 0 BFC CERTIFY, the winding of its faces can be trusted
+        self.certified = False
+
+    # while files are prefetched a file read here is parsed right away, see prefetch.parse
     def read_file(self):
-        if self.filepath in mpd_file_cache:
-            self.lines = mpd_file_cache[self.filepath].lines
+        mpd_file, filepath = resolve_filepath(self.filepath)
+        if mpd_file is None and filepath is None:
+            return False
+        if mpd_file is None:
+            self.source_path = filepath
+
+        entry, lines = prefetch.get(self.filepath)
+        if entry is None and lines is None:
+            if mpd_file is not None:
+                lines = mpd_file.lines
+            else:
+                if options.use_parse_cache:
+                    entry = parse_cache.read_entry(filepath)
+                if entry is None:
+                    lines = filesystem.read_file(filepath)
+            if entry is None:
+                entry = prefetch.parse(self.filepath, filepath, lines)
+
+        if entry is not None:
+            parse_cache.apply_entry(self, entry)
+            prefetch.discover(self.filepath, child_references=self.child_references)
         else:
-            # if missing, use a,b,c etc parts if available
-            # TODO: look in this file's directory and directories relative to this file's directory
-            filepath = filesystem.locate(self.filepath)
-            if filepath is None:
-                print(f"missing {self.filepath}")
-                return False
-            self.lines = filesystem.read_file(filepath)
+            self.lines = lines
+            prefetch.discover(self.filepath, lines=self.lines)
         return True
 
     def parse_file(self):
-        if len(self.lines) < 1:
+        if self.cached:
+            for child_reference in self.child_references:
+                self.add_child_node(child_reference)
+            return
+
+        if not self.lines:
+            # an empty file can still hold a mapping
+            self.lines = []
             return
 
         camera = None
         texmap_start = False
         texmap_next = False
         texmap_fallback = False
+        is_cw = False
+        invert_next = False
 
         for line in self.lines:
             params = helpers.parse_line(line, 15)
@@ -176,6 +310,9 @@ class LDrawFile:
                 continue
 
             if params[0] == "0":
+                if params[1].lower() in parse_worker.uncacheable_meta_commands:
+                    self.cacheable = False
+
                 if params[1].lower() in ["!colour"]:
                     ldraw_colors.parse_color(params)
                 elif params[1].lower() in ["!ldraw_org"]:
@@ -185,6 +322,8 @@ class LDrawFile:
                         self.part_type = params[2].lower()
                 elif params[1].lower() == "name:":
                     self.name = line[7:].lower().strip()
+                elif params[1].lower() in ["bfc"]:
+                    self.certified, is_cw, invert_next = helpers.parse_bfc(params, self.certified, is_cw, invert_next)
                 elif params[1].lower() in ["step"]:
                     if options.meta_step:
                         ldraw_node = LDrawNode(None)
@@ -352,17 +491,40 @@ class LDrawFile:
                 elif params[1].lower() in ["!:"] and texmap_start:
                     # remove 0 !: from line so that it can be parsed like a normal line
                     clean_line = re.sub(r"(.*?\s+!:\s+)", "", line)
-                    clean_params = params[2:]
-                    self.parse_geometry_line(clean_line, clean_params)
+                    clean_params = helpers.parse_line(clean_line, 15)
+                    if clean_params is not None:
+                        self.parse_geometry_line(clean_line, clean_params, is_cw, invert_next)
+                        if clean_params[0] == "1":
+                            invert_next = False
                     if texmap_next:
                         texmap_start, texmap_next, texmap_fallback = self.set_texmap_end()
             else:
                 if not (texmap_start and texmap_fallback):
-                    self.parse_geometry_line(line, params)
+                    self.parse_geometry_line(line, params, is_cw, invert_next)
+                if params[0] == "1":
+                    invert_next = False
+
+        # lines can hold the mapping of a big file
+        self.lines = []
+
+        self.geometry.finalize()
 
         if self.name == "":
             self.name = os.path.basename(self.filepath)
 
+        if options.use_parse_cache and self.source_path is not None and self.is_cacheable():
+            parse_cache.save(self, self.source_path)
+
+    def is_cacheable(self):
+        if not self.cacheable:
+            return False
+        if self.part_type in ldraw_part_types.model_types:
+            return False
+        for child_node in self.child_nodes:
+            if child_node.file is None:
+                return False
+        return True
+
     def set_texmap_end(self):
         ldraw_node = LDrawNode(None)
         ldraw_node.meta_command = "texmap_end"
@@ -373,20 +535,28 @@ class LDrawFile:
         texmap_fallback = False
         return texmap_start, texmap_next, texmap_fallback
 
-    def parse_geometry_line(self, line, params):
+    # is_cw is whether the line comes after 0 BFC CW, such faces are reversed so the faces of a file are all wound counterclockwise
+    # invert is whether the line comes right after 0 BFC INVERTNEXT
+    def parse_geometry_line(self, line, params, is_cw=False, invert=False):
         if params[0] == "1":
-            child_node = get_child_node(line, params)
-            if child_node is None:
-                return False
-            self.child_nodes.append(child_node)
-            if self.part_type in ldraw_part_types.model_types:
-                if child_node.file.part_type in ldraw_part_types.subpart_types:
-                    self.part_type = "part"
+            child_reference = helpers.parse_child_reference(params, invert)
+            self.child_references.append(child_reference)
+            return self.add_child_node(child_reference)
         elif params[0] in ["2"]:
             self.geometry.parse_edge(params)
             if self.part_type in ldraw_part_types.model_types:
                 self.part_type = "part"
         elif params[0] in ["3", "4"]:
-            self.geometry.parse_face(params)
+            self.geometry.parse_face(params, is_cw)
             if self.part_type in ldraw_part_types.model_types:
                 self.part_type = "part"
+
+    def add_child_node(self, child_reference):
+        child_node = get_child_node(*child_reference)
+        if child_node is None:
+            return False
+        self.child_nodes.append(child_node)
+        if self.part_type in ldraw_part_types.model_types:
+            if child_node.file.part_type in ldraw_part_types.subpart_types:
+                self.part_type = "part"
+        return True
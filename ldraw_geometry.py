@@ -1,42 +1,254 @@
-import mathutils
-from .face_info import FaceInfo
+from array import array
 
+import numpy as np
 
+from . import helpers
+
+
+# vertices are stored as contiguous (n, 3) float64 arrays and per face data as flat arrays
+# faces and edges hold the vertex count of each face/edge, their vertices follow each other in order
+# while a file is being parsed lines go into array.array buffers which grow amortized
+# finalize() turns those into numpy arrays once parsing is done
+# flattened geometry is allocated up front from a counting pass and filled in place by append()
+# with options.instance_studs studs aren't flattened, studs holds (stud file, color code, matrix) for each of them instead
+# faces are wound counterclockwise, they are reversed when they are appended with a mirroring matrix
+# or inverted by 0 BFC INVERTNEXT, but not both
 class LDrawGeometry:
     def __init__(self):
-        self.edge_vertices = []
-        self.edges = []
-        self.vertices = []
-        self.faces = []
-        self.face_info = []
+        self.vertices = np.empty((0, 3), dtype=np.float64)
+        self.faces = np.empty(0, dtype=np.int32)
+        self.face_color_codes = np.empty(0, dtype=np.int32)
+        self.face_use_edge_color = np.empty(0, dtype=bool)
+        self.face_grain_slope_allowed = np.empty(0, dtype=bool)
+        self.edge_vertices = np.empty((0, 3), dtype=np.float64)
+        self.edges = np.empty(0, dtype=np.int32)
+        self.studs = []
+
+        self.__vertex_buffer = array("d")
+        self.__face_buffer = array("i")
+        self.__color_buffer = array("i")
+        self.__cw_buffer = array("i")
+        self.__edge_vertex_buffer = array("d")
+        self.__edge_buffer = array("i")
+
+        self.__vertex_cursor = 0
+        self.__face_cursor = 0
+        self.__edge_vertex_cursor = 0
+        self.__edge_cursor = 0
 
     def parse_edge(self, params):
         vert_count = int(params[0])
 
-        vertices = []
-        for i in range(vert_count):
-            vertex = mathutils.Vector((float(params[i * 3 + 2]), float(params[i * 3 + 3]), float(params[i * 3 + 4])))
-            vertices.append(vertex)
-
-        self.edge_vertices.extend(vertices)
-        self.edges.append(vert_count)
+        self.__edge_vertex_buffer.extend(map(float, params[2:vert_count * 3 + 2]))
+        self.__edge_buffer.append(vert_count)
 
-    def parse_face(self, params):
+    # faces after 0 BFC CW are stored reversed
+    # their vertices are kept in file order until finalize() has fixed complex quads
+    def parse_face(self, params, is_cw=False):
         vert_count = int(params[0])
-        color_code = params[1]
-
-        vertices = []
-        for i in range(vert_count):
-            vertex = mathutils.Vector((float(params[i * 3 + 2]), float(params[i * 3 + 3]), float(params[i * 3 + 4])))
-            vertices.append(vertex)
-
-        # https://wiki.ldraw.org/wiki/LDraw_Files_Requirements#Complex_quadrilaterals
-        if vert_count == 4:
-            vA = (vertices[1] - vertices[0]).cross(vertices[2] - vertices[0])
-            vB = (vertices[2] - vertices[1]).cross(vertices[3] - vertices[1])
-            if vA.dot(vB) < 0:
-                vertices[2], vertices[3] = vertices[3], vertices[2]
-
-        self.vertices.extend(vertices)
-        self.faces.append(vert_count)
-        self.face_info.append(FaceInfo(color_code))
+
+        if is_cw:
+            self.__cw_buffer.append(len(self.__face_buffer))
+        self.__vertex_buffer.extend(map(float, params[2:vert_count * 3 + 2]))
+        self.__face_buffer.append(vert_count)
+        self.__color_buffer.append(helpers.color_code_to_int(params[1]))
+
+    def finalize(self):
+        if len(self.__face_buffer) > 0:
+            self.vertices = np.frombuffer(self.__vertex_buffer, dtype=np.float64).reshape(-1, 3)
+            self.faces = np.frombuffer(self.__face_buffer, dtype=np.int32)
+            self.face_color_codes = np.frombuffer(self.__color_buffer, dtype=np.int32)
+            self.face_use_edge_color = np.zeros(len(self.faces), dtype=bool)
+            self.face_grain_slope_allowed = np.ones(len(self.faces), dtype=bool)
+
+            # the fix depends on the order of the vertices in the file, so it comes before the reversal
+            self.__fix_complex_quads()
+            if len(self.__cw_buffer) > 0:
+                is_cw = np.zeros(len(self.faces), dtype=bool)
+                is_cw[np.frombuffer(self.__cw_buffer, dtype=np.int32)] = True
+                is_cw = np.repeat(is_cw, self.faces)
+                order = np.arange(len(self.vertices))
+                order[is_cw] = reversed_face_order(self.faces)[is_cw]
+                self.vertices = self.vertices[order]
+
+            self.__vertex_buffer = array("d")
+            self.__face_buffer = array("i")
+            self.__color_buffer = array("i")
+            self.__cw_buffer = array("i")
+
+        if len(self.__edge_buffer) > 0:
+            self.edge_vertices = np.frombuffer(self.__edge_vertex_buffer, dtype=np.float64).reshape(-1, 3)
+            self.edges = np.frombuffer(self.__edge_buffer, dtype=np.int32)
+            self.__edge_vertex_buffer = array("d")
+            self.__edge_buffer = array("i")
+
+    def allocate(self, vertex_count, face_count, edge_vertex_count, edge_count):
+        self.vertices = np.empty((vertex_count, 3), dtype=np.float64)
+        self.faces = np.empty(face_count, dtype=np.int32)
+        self.face_color_codes = np.empty(face_count, dtype=np.int32)
+        self.face_use_edge_color = np.empty(face_count, dtype=bool)
+        self.face_grain_slope_allowed = np.empty(face_count, dtype=bool)
+        self.edge_vertices = np.empty((edge_vertex_count, 3), dtype=np.float64)
+        self.edges = np.empty(edge_count, dtype=np.int32)
+
+        self.__vertex_cursor = 0
+        self.__face_cursor = 0
+        self.__edge_vertex_cursor = 0
+        self.__edge_cursor = 0
+
+    # transforms the faces of geometry by matrix and writes them at the end of the allocated buffers
+    # faces with color code 16 take color_code
+    def append(self, geometry, matrix, color_code, use_edge_color, grain_slope_allowed, is_inverted=False):
+        start, end = self.__append_faces(geometry, matrix, color_code, is_inverted)
+        self.face_use_edge_color[start:end] = use_edge_color
+        self.face_grain_slope_allowed[start:end] = grain_slope_allowed
+
+    # same as append, but the faces keep the flags they have in geometry
+    # for geometry that is itself flattened from several files
+    def append_subtree(self, geometry, matrix, color_code, is_inverted=False):
+        start, end = self.__append_faces(geometry, matrix, color_code, is_inverted)
+        self.face_use_edge_color[start:end] = geometry.face_use_edge_color
+        self.face_grain_slope_allowed[start:end] = geometry.face_grain_slope_allowed
+        self.__append_studs(geometry, [matrix], color_code)
+
+    def add_stud(self, ldraw_file, matrix, color_code):
+        self.studs.append((ldraw_file, color_code, np.array(matrix, dtype=np.float64)))
+
+    # same as append_subtree followed by append_edges for each matrix and is_inverted flag in order
+    # all the copies are transformed by a single batched matmul
+    def append_subtree_copies(self, geometry, matrices, color_code, is_inverted):
+        count = len(matrices)
+        m = np.array(matrices, dtype=np.float64).reshape(count, 4, 4)
+        rotations = m[:, :3, :3].transpose(0, 2, 1)
+        translations = m[:, np.newaxis, :3, 3]
+
+        face_count = len(geometry.faces)
+        if face_count > 0:
+            vertex_count = len(geometry.vertices)
+            start = self.__vertex_cursor
+            end = start + vertex_count * count
+            vertices = self.vertices[start:end].reshape(count, vertex_count, 3)
+            np.matmul(geometry.vertices, rotations, out=vertices)
+            vertices += translations
+            self.__vertex_cursor = end
+
+            is_reversed = (np.linalg.det(m[:, :3, :3]) < 0) != np.asarray(is_inverted, dtype=bool)
+            if np.any(is_reversed):
+                reversed_copies = vertices[is_reversed]
+                vertices[is_reversed] = reversed_copies[:, reversed_face_order(geometry.faces)]
+
+            face_color_codes = geometry.face_color_codes.copy()
+            face_color_codes[face_color_codes == 16] = color_code
+
+            start = self.__face_cursor
+            end = start + face_count * count
+            self.faces[start:end] = np.tile(geometry.faces, count)
+            self.face_color_codes[start:end] = np.tile(face_color_codes, count)
+            self.face_use_edge_color[start:end] = np.tile(geometry.face_use_edge_color, count)
+            self.face_grain_slope_allowed[start:end] = np.tile(geometry.face_grain_slope_allowed, count)
+            self.__face_cursor = end
+
+        edge_count = len(geometry.edges)
+        if edge_count > 0:
+            edge_vertex_count = len(geometry.edge_vertices)
+            start = self.__edge_vertex_cursor
+            end = start + edge_vertex_count * count
+            edge_vertices = self.edge_vertices[start:end].reshape(count, edge_vertex_count, 3)
+            np.matmul(geometry.edge_vertices, rotations, out=edge_vertices)
+            edge_vertices += translations
+            self.__edge_vertex_cursor = end
+
+            start = self.__edge_cursor
+            end = start + edge_count * count
+            self.edges[start:end] = np.tile(geometry.edges, count)
+            self.__edge_cursor = end
+
+        self.__append_studs(geometry, m, color_code)
+
+    def __append_studs(self, geometry, matrices, color_code):
+        if len(geometry.studs) < 1:
+            return
+
+        for matrix in matrices:
+            m = np.array(matrix, dtype=np.float64)
+            for ldraw_file, stud_color_code, stud_matrix in geometry.studs:
+                if stud_color_code == 16:
+                    stud_color_code = color_code
+                self.studs.append((ldraw_file, stud_color_code, m @ stud_matrix))
+
+    def __append_faces(self, geometry, matrix, color_code, is_inverted):
+        face_count = len(geometry.faces)
+        if face_count < 1:
+            return self.__face_cursor, self.__face_cursor
+
+        m = np.array(matrix, dtype=np.float64)
+
+        geometry_vertices = geometry.vertices
+        if (np.linalg.det(m[:3, :3]) < 0) != is_inverted:
+            geometry_vertices = geometry_vertices[reversed_face_order(geometry.faces)]
+
+        start = self.__vertex_cursor
+        end = start + len(geometry.vertices)
+        vertices = self.vertices[start:end]
+        np.matmul(geometry_vertices, m[:3, :3].T, out=vertices)
+        vertices += m[:3, 3]
+        self.__vertex_cursor = end
+
+        start = self.__face_cursor
+        end = start + face_count
+        self.faces[start:end] = geometry.faces
+        face_color_codes = self.face_color_codes[start:end]
+        face_color_codes[:] = geometry.face_color_codes
+        face_color_codes[geometry.face_color_codes == 16] = color_code
+        self.__face_cursor = end
+        return start, end
+
+    def append_edges(self, geometry, matrix):
+        edge_count = len(geometry.edges)
+        if edge_count < 1:
+            return
+
+        m = np.array(matrix, dtype=np.float64)
+
+        start = self.__edge_vertex_cursor
+        end = start + len(geometry.edge_vertices)
+        edge_vertices = self.edge_vertices[start:end]
+        np.matmul(geometry.edge_vertices, m[:3, :3].T, out=edge_vertices)
+        edge_vertices += m[:3, 3]
+        self.__edge_vertex_cursor = end
+
+        start = self.__edge_cursor
+        end = start + edge_count
+        self.edges[start:end] = geometry.edges
+        self.__edge_cursor = end
+
+    # https://wiki.ldraw.org/wiki/LDraw_Files_Requirements#Complex_quadrilaterals
+    # done for every quad of the file at once after parsing
+    def __fix_complex_quads(self):
+        quads = np.flatnonzero(self.faces == 4)
+        if len(quads) < 1:
+            return
+
+        starts = (np.cumsum(self.faces) - self.faces)[quads]
+        v = self.vertices
+        v0 = v[starts]
+        v1 = v[starts + 1]
+        v2 = v[starts + 2]
+        v3 = v[starts + 3]
+        vA = np.cross(v1 - v0, v2 - v0)
+        vB = np.cross(v2 - v1, v3 - v1)
+        complex_starts = starts[np.einsum("ij,ij->i", vA, vB) < 0]
+        v[complex_starts + 2], v[complex_starts + 3] = v[complex_starts + 3], v[complex_starts + 2]
+
+    def nbytes(self):
+        return (self.vertices.nbytes + self.faces.nbytes + self.face_color_codes.nbytes +
+                self.face_use_edge_color.nbytes + self.face_grain_slope_allowed.nbytes +
+                self.edge_vertices.nbytes + self.edges.nbytes)
+
+
+# the order that reverses the vertices of every face, faces holds the vertex count of each face
+def reversed_face_order(faces):
+    ends = np.cumsum(faces)
+    starts = ends - faces
+    # vertex i of a face from start to end takes the place of vertex start + end - 1 - i
+    return np.repeat(starts + ends - 1, faces) - np.arange(np.sum(faces))
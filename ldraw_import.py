@@ -1,10 +1,15 @@
 import bpy
 
+from . import strings
 from . import options
 from . import filesystem
 
 from . import ldraw_node
 from . import ldraw_file
+from . import parse_cache
+from . import prefetch
+from . import session_cache
+from . import hidden_faces
 from . import ldraw_camera
 from . import blender_materials
 from . import special_bricks
@@ -15,8 +20,13 @@ def do_import(filename):
     bpy.context.scene.eevee.use_ssr_refraction = True
     bpy.context.scene.eevee.use_taa_reprojection = True
 
+    options.capture_fingerprint()
     special_bricks.build_slope_angles()
     ldraw_file.reset_caches()
+    parse_cache.reset_caches()
+    prefetch.reset_caches()
+    session_cache.reset_caches()
+    hidden_faces.reset_caches()
     ldraw_node.reset_caches()
     ldraw_camera.reset_caches()
     filesystem.build_search_paths()
@@ -26,32 +36,105 @@ def do_import(filename):
     if options.all_materials:
         blender_materials.create_ldraw_materials()
 
-    filename = ldraw_file.handle_mpd(filename)
-    if filename is None:
-        return
+    try:
+        filename = ldraw_file.handle_mpd(filename)
+        if filename is None:
+            return
 
-    file = ldraw_file.LDrawFile(filename)
-    file.read_file()
-    file.parse_file()
+        # after handle_mpd so that workers see every file embedded in the mpd
+        prefetch.start()
 
-    root_node = ldraw_node.LDrawNode(file)
-    root_node.load()
+        try:
+            file = ldraw_file.LDrawFile(filename)
+            file.read_file()
+            file.parse_file()
+        finally:
+            prefetch.reset_caches()
 
-    if ldraw_node.top_collection is not None:
-        bpy.context.scene.collection.children.link(ldraw_node.top_collection)
+        if options.use_parse_cache:
+            parse_cache.prune()
 
-    if options.meta_step:
-        if options.set_end_frame:
-            bpy.context.scene.frame_end = ldraw_node.last_frame + options.frames_per_step
-            bpy.context.scene.frame_set(bpy.context.scene.frame_end)
+        root_node = ldraw_node.LDrawNode(file)
+        root_node.load()
 
-    for area in bpy.context.screen.areas:
-        if area.type == "VIEW_3D":
-            for space in area.spaces:
-                if space.type == "VIEW_3D":
-                    space.clip_end = options.camera_far  # * options.import_scale
+        if ldraw_node.top_collection is not None:
+            bpy.context.scene.collection.children.link(ldraw_node.top_collection)
 
-    for camera in ldraw_camera.cameras:
-        blender_camera = ldraw_camera.create_camera(camera, empty=ldraw_node.top_empty, collection=ldraw_node.top_collection)
-        if bpy.context.scene.camera is None:
-            bpy.context.scene.camera = blender_camera
+        ldraw_node.create_merged_meshes()
+
+        # after the top collection is linked so the studs can be hidden in the view layer
+        ldraw_node.create_stud_instances()
+
+        # parts hidden until a later step would still remove faces of the parts below them
+        # merged meshes span the whole model, so there are no neighbouring parts to look for
+        if options.remove_hidden_faces and not options.meta_step and options.merge_parts == "none" and ldraw_node.top_collection is not None:
+            hidden_faces.remove_hidden_faces(ldraw_node.top_collection.all_objects)
+
+        if options.build_lods:
+            build_lods()
+
+        if options.meta_step:
+            if options.set_end_frame:
+                bpy.context.scene.frame_end = ldraw_node.last_frame + options.frames_per_step
+                bpy.context.scene.frame_set(bpy.context.scene.frame_end)
+
+        for area in bpy.context.screen.areas:
+            if area.type == "VIEW_3D":
+                for space in area.spaces:
+                    if space.type == "VIEW_3D":
+                        space.clip_end = options.camera_far  # * options.import_scale
+
+        for camera in ldraw_camera.cameras:
+            blender_camera = ldraw_camera.create_camera(camera, empty=ldraw_node.top_empty, collection=ldraw_node.top_collection)
+            if bpy.context.scene.camera is None:
+                bpy.context.scene.camera = blender_camera
+    finally:
+        ldraw_file.release_mpd_files()
+
+
+lod_resolutions = ["Low", "Standard", "High"]
+
+
+# loads every part built during the import again at the other resolutions, once per part and color
+# each mesh of a part gets the names of all of its levels under strings.ldraw_lod_key
+# so operator_lod can swap the mesh of an object for another level
+def build_lods():
+    resolution = options.resolution
+    levels = {}
+    for key, part_file in ldraw_node.lod_parts.items():
+        levels[key] = {resolution: ldraw_node.mesh_cache[key]}
+
+    try:
+        for lod_resolution in lod_resolutions:
+            if lod_resolution == resolution:
+                continue
+
+            options.resolution = lod_resolution
+            options.capture_fingerprint()
+            filesystem.build_search_paths()
+            ldraw_file.reset_resolved_filepaths()
+
+            # the file cache is keyed by resolution, so everything below a part is parsed again
+            # the parse cache on disk doesn't depend on resolution and still saves reading the files
+            for key, part_file in ldraw_node.lod_parts.items():
+                lod_file = ldraw_file.LDrawFile(part_file.filepath)
+                if not lod_file.read_file():
+                    continue
+                lod_file.parse_file()
+
+                lod_mesh = ldraw_node.get_lod_mesh(key, lod_file)
+                if lod_mesh is not None:
+                    levels[key][lod_resolution] = lod_mesh
+    finally:
+        options.resolution = resolution
+        options.capture_fingerprint()
+        filesystem.build_search_paths()
+        ldraw_file.reset_resolved_filepaths()
+
+    for meshes in levels.values():
+        names = {lod_resolution: mesh.name for lod_resolution, mesh in meshes.items()}
+        for mesh in meshes.values():
+            mesh[strings.ldraw_lod_key] = names
+            # levels no object uses yet would be dropped when the file is saved
+            if mesh.users < 1:
+                mesh.use_fake_user = True
@@ -1,27 +1,46 @@
 import os
 import bpy
 import math
-import mathutils
 import bmesh
+import numpy as np
 
 from . import strings
 from . import options
 from . import matrices
 from . import ldraw_part_types
+from . import helpers
 
-from .ldraw_geometry import LDrawGeometry
-from .face_info import FaceInfo
+from .ldraw_geometry import LDrawGeometry, reversed_face_order
 from . import blender_materials
 from . import ldraw_colors
 from . import special_bricks
+from . import session_cache
 
 part_count = 0
 current_step = 0
 last_frame = 0
-face_info_cache = {}
 geometry_cache = {}
+mesh_cache = {}
+edge_mesh_cache = {}
+object_material_cache = {}
+subtree_counts = {}
+subtree_cache = {}
+flattenable_files = {}
+certified_files = {}
+subtree_hits = 0
+subtree_misses = 0
 top_collection = None
 top_empty = None
+instance_collection_cache = {}
+instances_collection = None
+building_instance = False
+instance_count = 0
+stud_carriers = {}
+lod_parts = {}
+merge_groups = {}
+merge_mesh_data = {}
+merge_piece_cache = {}
+merged_part_count = 0
 gap_scale_empty = None
 collection_id_map = {}
 next_collection = None
@@ -34,10 +53,28 @@ def reset_caches():
     global part_count
     global current_step
     global last_frame
-    global face_info_cache
     global geometry_cache
+    global mesh_cache
+    global edge_mesh_cache
+    global object_material_cache
+    global subtree_counts
+    global subtree_cache
+    global flattenable_files
+    global certified_files
+    global subtree_hits
+    global subtree_misses
     global top_collection
     global top_empty
+    global instance_collection_cache
+    global instances_collection
+    global building_instance
+    global instance_count
+    global stud_carriers
+    global lod_parts
+    global merge_groups
+    global merge_mesh_data
+    global merge_piece_cache
+    global merged_part_count
     global gap_scale_empty
     global collection_id_map
     global next_collection
@@ -47,10 +84,28 @@ def reset_caches():
     part_count = 0
     current_step = 0
     last_frame = 0
-    face_info_cache = {}
     geometry_cache = {}
+    mesh_cache = {}
+    edge_mesh_cache = {}
+    object_material_cache = {}
+    subtree_counts = {}
+    subtree_cache = {}
+    flattenable_files = {}
+    certified_files = {}
+    subtree_hits = 0
+    subtree_misses = 0
     top_collection = None
     top_empty = None
+    instance_collection_cache = {}
+    instances_collection = None
+    building_instance = False
+    instance_count = 0
+    stud_carriers = {}
+    lod_parts = {}
+    merge_groups = {}
+    merge_mesh_data = {}
+    merge_piece_cache = {}
+    merged_part_count = 0
     gap_scale_empty = None
     collection_id_map = {}
     next_collection = None
@@ -70,6 +125,37 @@ def set_step():
         bpy.context.scene.timeline_markers.new("STEP", frame=last_frame)
 
 
+# the name of the mesh of a part, only built when the mesh is looked up for the first time during an import
+# the same names as before keys were tuples, so meshes already in the blend file are reused
+# is_inverted is whether the part was placed right after 0 BFC INVERTNEXT
+def mesh_name(key):
+    fingerprint, color_code, filename, is_inverted = key
+
+    name = []
+    name.append(fingerprint.resolution)
+    name.append(color_code)
+    if fingerprint.chosen_logo is not None:
+        name.append(fingerprint.chosen_logo)
+    if fingerprint.remove_doubles:
+        name.append("rd")
+    if fingerprint.smooth_type == "auto_smooth":
+        name.append("as")
+    if fingerprint.smooth_type == "edge_split":
+        name.append("es")
+    if fingerprint.use_alt_colors:
+        name.append("alt")
+    if fingerprint.add_subsurface:
+        name.append("ss")
+    if fingerprint.instance_studs:
+        name.append("is")
+    if color_code == "24":
+        name.append("edge")
+    if is_inverted:
+        name.append("inv")
+    name.append(filename)
+    return "_".join([n.lower() for n in name])
+
+
 def create_meta_group(key, parent_collection):
     if key not in bpy.data.collections:
         bpy.data.collections.new(key)
@@ -101,10 +187,423 @@ def apply_slope_materials(mesh, filename):
             f.material_index = mesh.materials.find(material.name)
 
 
+# for parts built with shared meshes
+# points the slots of obj that hold the color 16 materials of its mesh at the materials of color_code
+# the slots are linked to the object, so the mesh keeps color 16 and stays shared by every color
+def apply_object_materials(obj, key, color_code):
+    for i, material in object_slot_materials(obj.data, key, color_code):
+        slot = obj.material_slots[i]
+        slot.link = "OBJECT"
+        slot.material = material
+
+
+# (slot index, material) for each color 16 material of mesh in color_code
+def object_slot_materials(mesh, key, color_code):
+    slot_materials = object_material_cache.get((key, color_code))
+    if slot_materials is None:
+        inherit_color = ldraw_colors.get_color("16")
+        color = ldraw_colors.get_color(color_code)
+
+        # material name => is_slope_material
+        inherit_materials = {
+            blender_materials.material_name(inherit_color): False,
+            blender_materials.material_name(inherit_color, is_slope_material=True): True,
+        }
+
+        slot_materials = []
+        for i, mesh_material in enumerate(mesh.materials):
+            if mesh_material is None or mesh_material.name not in inherit_materials:
+                continue
+            material = blender_materials.get_material(color, is_slope_material=inherit_materials[mesh_material.name])
+            if material is None:
+                continue
+            slot_materials.append((i, material))
+        object_material_cache[(key, color_code)] = slot_materials
+    return slot_materials
+
+
+# with display_logo get_child_node has already swapped stud.dat for its logo version, stud-logo4.dat say
+# that file is still a stud, and the instanced stud mesh is built from it so the studs keep their logo
+def is_instanced_stud(ldraw_file):
+    if not options.fingerprint.instance_studs:
+        return False
+
+    name = ldraw_file.name
+    logo_suffix = f"-{options.fingerprint.chosen_logo}.dat"
+    if options.fingerprint.chosen_logo is not None and name.endswith(logo_suffix):
+        name = name[:-len(logo_suffix)] + ".dat"
+    return name in special_bricks.studs
+
+
+# the children of ldraw_file whose geometry ends up in its flattened geometry
+def __geometry_children(ldraw_file):
+    children = []
+    for child in ldraw_file.child_nodes:
+        if child.file is None:
+            continue
+        if options.no_studs and child.file.name.startswith("stud"):
+            continue
+        if is_instanced_stud(child.file):
+            continue
+        children.append(child)
+    return children
+
+
+# records the studs referenced directly by ldraw_file in geometry instead of flattening them
+def __add_child_studs(geometry, ldraw_file, matrix, color_code):
+    if not options.fingerprint.instance_studs:
+        return
+
+    for child in ldraw_file.child_nodes:
+        if child.file is None or not is_instanced_stud(child.file):
+            continue
+        child_color_code = color_code
+        if child.color_code != "16":
+            child_color_code = child.color_code
+        geometry.add_stud(child.file, matrix @ child.matrix, helpers.color_code_to_int(child_color_code))
+
+
+def __count_key(ldraw_file, is_edge_logo):
+    if ldraw_file.name in ["logo.dat", "logo2.dat"]:
+        is_edge_logo = True
+    return ldraw_file, is_edge_logo
+
+
+# the number of vertices, faces, edge vertices and edges a file adds when flattened with everything below it
+# used to size the buffers of a part's geometry before it is filled
+# like the rest of the traversal this uses an explicit stack, children are counted before the files that reference them
+def count_geometry(ldraw_file, is_edge_logo=False):
+    root_key = __count_key(ldraw_file, is_edge_logo)
+
+    stack = [(root_key, False)]
+    while len(stack) > 0:
+        key, children_counted = stack.pop()
+        if key in subtree_counts:
+            continue
+
+        ldraw_file, is_edge_logo = key
+        child_keys = [__count_key(child.file, is_edge_logo) for child in __geometry_children(ldraw_file)]
+
+        if not children_counted:
+            stack.append((key, True))
+            for child_key in child_keys:
+                if child_key not in subtree_counts:
+                    stack.append((child_key, False))
+            continue
+
+        geometry = ldraw_file.geometry
+        vertex_count = len(geometry.vertices)
+        face_count = len(geometry.faces)
+        edge_vertex_count = 0
+        edge_count = 0
+        if (not is_edge_logo) or (is_edge_logo and options.display_logo):
+            edge_vertex_count = len(geometry.edge_vertices)
+            edge_count = len(geometry.edges)
+
+        for child_key in child_keys:
+            counts = subtree_counts[child_key]
+            vertex_count += counts[0]
+            face_count += counts[1]
+            edge_vertex_count += counts[2]
+            edge_count += counts[3]
+
+        subtree_counts[key] = (vertex_count, face_count, edge_vertex_count, edge_count)
+
+    return subtree_counts[root_key]
+
+
+# files without models or meta commands anywhere below them
+# their geometry can be flattened once and reused wherever they are referenced
+def is_flattenable(ldraw_file):
+    stack = [(ldraw_file, False)]
+    while len(stack) > 0:
+        current_file, children_checked = stack.pop()
+        if current_file in flattenable_files:
+            continue
+
+        if current_file.part_type in ldraw_part_types.model_types:
+            flattenable_files[current_file] = False
+            continue
+
+        if not children_checked:
+            stack.append((current_file, True))
+            for child in current_file.child_nodes:
+                if child.file is not None and child.file not in flattenable_files:
+                    stack.append((child.file, False))
+            continue
+
+        flattenable = True
+        for child in current_file.child_nodes:
+            if child.file is None or not flattenable_files[child.file]:
+                flattenable = False
+                break
+        flattenable_files[current_file] = flattenable
+
+    return flattenable_files[ldraw_file]
+
+
+# files certified with 0 BFC CERTIFY whose flattened children are all certified too
+# their faces are wound counterclockwise once flattened, so their normals don't need to be recalculated
+def is_certified(ldraw_file):
+    stack = [(ldraw_file, False)]
+    while len(stack) > 0:
+        current_file, children_checked = stack.pop()
+        if current_file in certified_files:
+            continue
+
+        children = __geometry_children(current_file)
+
+        if not children_checked:
+            stack.append((current_file, True))
+            for child in children:
+                if child.file not in certified_files:
+                    stack.append((child.file, False))
+            continue
+
+        certified = current_file.certified
+        for child in children:
+            if not certified_files[child.file]:
+                certified = False
+                break
+        certified_files[current_file] = certified
+
+    return certified_files[ldraw_file]
+
+
+def __subtree_key(ldraw_file, color_code, is_stud, is_edge_logo):
+    if ldraw_file.name in ["stud.dat", "stud2.dat"]:
+        is_stud = True
+
+    if ldraw_file.name in ["logo.dat", "logo2.dat"]:
+        is_edge_logo = True
+
+    if color_code != "24":
+        color_code = "16"
+
+    return ldraw_file, color_code, is_stud, is_edge_logo
+
+
+# (child node, color code it's appended with, key of its subtree) for each child in the subtree of key
+def __subtree_children(key):
+    ldraw_file, color_code, is_stud, is_edge_logo = key
+
+    children = []
+    for child in __geometry_children(ldraw_file):
+        child_color_code = color_code
+        if child.color_code != "16":
+            child_color_code = child.color_code
+        children.append((child, child_color_code, __subtree_key(child.file, child_color_code, is_stud, is_edge_logo)))
+    return children
+
+
+# the geometry of ldraw_file and everything below it in the file's own coordinates, flattened once per import
+# faces that inherit their color keep color code 16 so they can take the color of each reference
+# color code 24 is flattened separately because faces that inherit it are also marked as using the edge color
+def get_subtree(ldraw_file, color_code, is_stud, is_edge_logo):
+    global subtree_hits
+    global subtree_misses
+
+    root_key = __subtree_key(ldraw_file, color_code, is_stud, is_edge_logo)
+    subtree = subtree_cache.get(root_key)
+    if subtree is not None:
+        subtree_hits += 1
+        return subtree
+
+    # child subtrees are flattened before the subtrees that reference them
+    # each subtree flattened here was asked for once, by the root or a reference, every other reference is a hit
+    flattened_count = 0
+    reference_count = 0
+
+    stack = [(root_key, False)]
+    while len(stack) > 0:
+        key, children_flattened = stack.pop()
+        if key in subtree_cache:
+            continue
+
+        children = __subtree_children(key)
+
+        if not children_flattened:
+            stack.append((key, True))
+            for child, child_color_code, child_key in children:
+                if child_key not in subtree_cache:
+                    stack.append((child_key, False))
+            continue
+
+        ldraw_file, color_code, is_stud, is_edge_logo = key
+
+        subtree = LDrawGeometry()
+        subtree.allocate(*count_geometry(ldraw_file, is_edge_logo))
+
+        subtree.append(
+            ldraw_file.geometry,
+            matrices.identity,
+            helpers.color_code_to_int(color_code),
+            use_edge_color=color_code == "24",
+            grain_slope_allowed=not is_stud,
+        )
+
+        if (not is_edge_logo) or (is_edge_logo and options.display_logo):
+            subtree.append_edges(ldraw_file.geometry, matrices.identity)
+
+        for child, child_color_code, child_key in children:
+            child_subtree = subtree_cache[child_key]
+            subtree.append_subtree(child_subtree, child.matrix, helpers.color_code_to_int(child_color_code), child.invert)
+            subtree.append_edges(child_subtree, child.matrix)
+
+        __add_child_studs(subtree, ldraw_file, matrices.identity, color_code)
+
+        subtree_cache[key] = subtree
+        flattened_count += 1
+        reference_count += len(children)
+
+    subtree_misses += flattened_count
+    subtree_hits += reference_count - (flattened_count - 1)
+    return subtree_cache[root_key]
+
+
+# appends the subtree of every child of ldraw_file to geometry, for files whose children are all flattenable
+# consecutive references to the same subtree in the same color, like a row of studs, are appended as one batch
+def append_child_subtrees(geometry, ldraw_file, matrix, color_code, is_stud, is_edge_logo, is_inverted=False):
+    batch_subtree = None
+    batch_color_code = None
+    batch_matrices = []
+    batch_inverted = []
+
+    for child in __geometry_children(ldraw_file):
+        child_color_code = color_code
+        if child.color_code != "16":
+            child_color_code = child.color_code
+
+        subtree = get_subtree(child.file, child_color_code, is_stud, is_edge_logo)
+        if subtree is not batch_subtree or child_color_code != batch_color_code:
+            if batch_subtree is not None:
+                geometry.append_subtree_copies(batch_subtree, batch_matrices, helpers.color_code_to_int(batch_color_code), batch_inverted)
+            batch_subtree = subtree
+            batch_color_code = child_color_code
+            batch_matrices = []
+            batch_inverted = []
+        batch_matrices.append(matrix @ child.matrix)
+        batch_inverted.append(is_inverted != child.invert)
+
+    if batch_subtree is not None:
+        geometry.append_subtree_copies(batch_subtree, batch_matrices, helpers.color_code_to_int(batch_color_code), batch_inverted)
+
+    __add_child_studs(geometry, ldraw_file, matrix, color_code)
+
+
+def get_mesh(key, geometry, ldraw_file):
+    mesh = mesh_cache.get(key)
+    if mesh is not None:
+        return mesh
+
+    name = mesh_name(key)
+    if name not in bpy.data.meshes:
+        mesh, face_indices = create_part_mesh(name, geometry)
+
+        # apply materials to mesh
+        # then mesh cleanup
+        # then apply slope materials
+        # welding drops faces, so the faces of the mesh are matched to the per face arrays of geometry
+        # through face_indices, slope materials are applied after cleanup because they depend on the face normals
+        apply_materials(mesh, geometry, face_indices)
+        bmesh_ops(mesh, geometry, is_certified(ldraw_file))
+        apply_slope_materials(mesh, ldraw_file.name)
+
+        if options.smooth_type == "auto_smooth":
+            mesh.use_auto_smooth = options.shade_smooth
+            mesh.auto_smooth_angle = math.radians(89.9)  # 1.56905 - 89.9 so 90 degrees and up are affected
+        if options.make_gaps and options.gap_target == "mesh":
+            mesh.transform(matrices.scaled_matrix(options.gap_scale))
+        mesh[strings.ldraw_filename_key] = ldraw_file.name
+    mesh = bpy.data.meshes[name]
+    mesh_cache[key] = mesh
+    return mesh
+
+
+# the mesh of a part loaded again at another resolution for options.build_lods
+# key is the key the part had, ldraw_file the part parsed at the resolution options are now set to
+# only parts that flatten completely get levels, None for the others
+def get_lod_mesh(key, ldraw_file):
+    if not is_flattenable(ldraw_file):
+        return None
+
+    _, color_code, filename, is_inverted = key
+    lod_key = (options.fingerprint, color_code, filename, is_inverted)
+
+    geometry = geometry_cache.get(lod_key)
+    if geometry is None:
+        subtree = get_subtree(ldraw_file, color_code, False, False)
+        geometry = LDrawGeometry()
+        geometry.allocate(*count_geometry(ldraw_file))
+        geometry.append_subtree(subtree, matrices.identity, helpers.color_code_to_int(color_code), is_inverted)
+        geometry.append_edges(subtree, matrices.identity)
+        geometry_cache[lod_key] = geometry
+
+    return get_mesh(lod_key, geometry, ldraw_file)
+
+
+# the collection a submodel is built into once per color for options.instance_submodels
+# the objects in it are in ldraw coordinates and every placement of the submodel is an empty instancing it
+# keyed by filepath, a submodel in an mpd and a file on disk may have the same name
+def get_instance_collection(ldraw_file, color_code):
+    global instances_collection
+    global building_instance
+
+    key = (options.fingerprint, color_code, ldraw_file.filepath)
+    collection = instance_collection_cache.get(key)
+    if collection is not None:
+        return collection
+
+    # excluded from the view layer so only the instances are seen
+    if instances_collection is None:
+        instances_collection = bpy.data.collections.new("Submodels")
+        bpy.context.scene.collection.children.link(instances_collection)
+        bpy.context.view_layer.layer_collection.children[instances_collection.name].exclude = True
+
+    collection = bpy.data.collections.new(os.path.basename(ldraw_file.filepath))
+    instances_collection.children.link(collection)
+    instance_collection_cache[key] = collection
+
+    was_building_instance = building_instance
+    building_instance = True
+    try:
+        for child in ldraw_file.child_nodes:
+            child.load(parent_color_code=color_code, parent_collection=collection)
+    finally:
+        building_instance = was_building_instance
+
+    return collection
+
+
+def create_instance(collection, parent_matrix, matrix, color_code):
+    global instance_count
+
+    obj = bpy.data.objects.new(collection.name, None)
+    obj.instance_type = "COLLECTION"
+    obj.instance_collection = collection
+    obj[strings.ldraw_color_code_key] = color_code
+    instance_count += 1
+
+    if building_instance:
+        obj.matrix_world = parent_matrix @ matrix
+    elif top_empty is None:
+        obj.matrix_world = matrices.scaled_matrix(options.import_scale) @ matrices.rotation @ parent_matrix @ matrix
+    else:
+        obj.matrix_world = parent_matrix @ matrix
+        obj.parent = top_empty
+
+    return obj
+
+
 def create_object(mesh, parent_matrix, matrix):
     obj = bpy.data.objects.new(mesh.name, mesh)
 
-    if top_empty is None:
+    if building_instance:
+        # placed by the empties instancing it, so no parent and no gap constraint
+        obj.matrix_world = parent_matrix @ matrix
+        if options.make_gaps and options.gap_target == "object":
+            obj.matrix_world = obj.matrix_world @ matrices.scaled_matrix(options.gap_scale)
+    elif top_empty is None:
         obj.matrix_world = matrices.scaled_matrix(options.import_scale) @ matrices.rotation @ parent_matrix @ matrix
         if options.make_gaps and options.gap_target == "object":
             obj.matrix_world = obj.matrix_world @ matrices.scaled_matrix(options.gap_scale)
@@ -131,25 +630,15 @@ def create_object(mesh, parent_matrix, matrix):
     # https://docs.blender.org/api/current/bpy.types.bpy_struct.html#bpy.types.bpy_struct.keyframe_insert
     # https://docs.blender.org/api/current/bpy.types.Scene.html?highlight=frame_set#bpy.types.Scene.frame_set
     # https://docs.blender.org/api/current/bpy.types.Object.html?highlight=rotation_quaternion#bpy.types.Object.rotation_quaternion
-    if options.meta_step:
-        if options.debug_text:
-            print(current_step)
+    if options.meta_step and not building_instance:
+        keyframe_step(obj, last_frame)
 
-        bpy.context.scene.frame_set(options.starting_step_frame)
-        obj.hide_viewport = True
-        obj.hide_render = True
-        obj.keyframe_insert(data_path="hide_render")
-        obj.keyframe_insert(data_path="hide_viewport")
+    add_modifiers(obj)
 
-        bpy.context.scene.frame_set(last_frame)
-        obj.hide_viewport = False
-        obj.hide_render = False
-        obj.keyframe_insert(data_path="hide_render")
-        obj.keyframe_insert(data_path="hide_viewport")
+    return obj
 
-        if options.debug_text:
-            print(last_frame)
 
+def add_modifiers(obj):
     if options.smooth_type == "edge_split":
         edge_modifier = obj.modifiers.new("Edge Split", type='EDGE_SPLIT')
         edge_modifier.use_edge_angle = True
@@ -164,7 +653,417 @@ def create_object(mesh, parent_matrix, matrix):
         bevel_modifier.limit_method = "WEIGHT"
         bevel_modifier.use_clamp_overlap = True
 
-    return obj
+
+# with options.merge_parts parts aren't made into objects, each one is added to a group of the parts
+# of its collection, or of the whole model, and of its step that are joined into one mesh per material
+# key and geometry are the part's flattened geometry, faces of color 16 in it take color_code
+def add_merged_part(key, geometry, ldraw_file, color_code, matrix, collection):
+    global merged_part_count
+
+    if options.merge_parts == "model" and not building_instance:
+        collection = top_collection
+
+    frame = None
+    if options.meta_step and not building_instance:
+        frame = last_frame
+
+    m = np.array(matrix, dtype=np.float64)
+    if options.make_gaps and options.gap_target == "object":
+        m = m @ np.array(matrices.scaled_matrix(options.gap_scale), dtype=np.float64)
+
+    group_key = (collection, building_instance, frame)
+    group = merge_groups.get(group_key)
+    if group is None:
+        group = []
+        merge_groups[group_key] = group
+    group.append((key, geometry, color_code, m, ldraw_file.name, is_certified(ldraw_file)))
+    merged_part_count += 1
+
+
+# the faces of a part built from its flattened geometry the way create_part_mesh and bmesh_ops build its mesh, once per key
+# (vertices, face sizes, loop vertices, face color codes, face use_edge_color, sorted edge keys, edge is_sharp)
+def __merge_data(key, geometry):
+    data = merge_mesh_data.get(key)
+    if data is not None:
+        return data
+
+    vertices = geometry.vertices
+    faces = geometry.faces
+    loop_vertices = np.arange(len(vertices), dtype=np.int32)
+    face_indices = np.arange(len(faces))
+    if options.remove_doubles and np.all(np.isfinite(vertices)):
+        vertices, loop_vertices, faces, face_indices = weld_vertices(vertices, faces, options.merge_distance)
+
+    # at the precision blender stores coordinates in, like mark_sharp_edges compares them
+    vertices = vertices.astype(np.float32).astype(np.float64)
+
+    vertex_count = len(vertices)
+    edge_keys = __face_edge_keys(loop_vertices, faces, vertex_count)
+    edges = np.stack([edge_keys // vertex_count, edge_keys % vertex_count], axis=1)
+    is_sharp = sharp_edges(vertices, edges, geometry)
+
+    if options.make_gaps and options.gap_target == "mesh":
+        vertices = vertices * options.gap_scale
+
+    data = (
+        vertices,
+        faces,
+        loop_vertices,
+        geometry.face_color_codes[face_indices],
+        geometry.face_use_edge_color[face_indices],
+        edge_keys,
+        is_sharp,
+    )
+    merge_mesh_data[key] = data
+    return data
+
+
+# the sorted keys of the edges between the loops of faces, see __edge_keys
+def __face_edge_keys(loop_vertices, faces, vertex_count):
+    starts = np.cumsum(faces) - faces
+    next_loops = np.arange(1, len(loop_vertices) + 1)
+    next_loops[starts + faces - 1] = starts
+    return np.unique(__edge_keys(loop_vertices, loop_vertices[next_loops], vertex_count))
+
+
+# the faces of a part in color_code split by material, read once per key and color
+# material => (vertices, face sizes, loop vertices, edges, edge is_sharp) with vertices indexed from 0
+# faces whose color has no material are under None
+def __merge_pieces(key, geometry, color_code):
+    pieces = merge_piece_cache.get((key, color_code))
+    if pieces is not None:
+        return pieces
+
+    vertices, faces, loop_vertices, face_color_codes, face_use_edge_color, edge_keys, is_sharp = __merge_data(key, geometry)
+    face_color_codes = np.where(face_color_codes == 16, helpers.color_code_to_int(color_code), face_color_codes)
+
+    # material => [face indices], the materials in the order they first appear like apply_materials
+    material_faces = {}
+    face_keys = np.stack([face_color_codes, face_use_edge_color], axis=1).astype(np.int64)
+    keys, first_faces, face_key_indices = np.unique(face_keys, axis=0, return_index=True, return_inverse=True)
+    face_key_indices = face_key_indices.reshape(-1)
+    for key_index in np.argsort(first_faces).tolist():
+        face_color_code, use_edge_color = keys[key_index].tolist()
+        color = ldraw_colors.get_color(helpers.int_to_color_code(face_color_code))
+        material = blender_materials.get_material(color, use_edge_color=bool(use_edge_color))
+        material_faces.setdefault(material, []).append(np.flatnonzero(face_key_indices == key_index))
+
+    vertex_count = len(vertices)
+    starts = np.cumsum(faces) - faces
+    pieces = {}
+    for material, piece_faces in material_faces.items():
+        piece_faces = np.sort(np.concatenate(piece_faces))
+        face_totals = faces[piece_faces]
+        face_starts = np.cumsum(face_totals) - face_totals
+        loops = np.arange(np.sum(face_totals)) - np.repeat(face_starts - starts[piece_faces], face_totals)
+        face_loop_vertices = loop_vertices[loops]
+
+        used = np.unique(face_loop_vertices)
+        remap = np.full(vertex_count, -1, dtype=np.int32)
+        remap[used] = np.arange(len(used), dtype=np.int32)
+
+        # only the edges of the faces in the piece, with the sharp flags they have in the part
+        piece_edge_keys = __face_edge_keys(face_loop_vertices, face_totals, vertex_count)
+        piece_edges = np.stack([piece_edge_keys // vertex_count, piece_edge_keys % vertex_count], axis=1)
+
+        pieces[material] = (
+            vertices[used],
+            face_totals,
+            remap[face_loop_vertices],
+            remap[piece_edges],
+            is_sharp[np.searchsorted(edge_keys, piece_edge_keys)],
+        )
+
+    merge_piece_cache[(key, color_code)] = pieces
+    return pieces
+
+
+# builds the meshes of the groups gathered by add_merged_part, once everything has been loaded
+def create_merged_meshes():
+    for (collection, in_instance, frame), parts in merge_groups.items():
+        # material => [(piece, matrix, part index, filename, certified)]
+        pieces = {}
+        for part_index, (key, geometry, color_code, matrix, filename, certified) in enumerate(parts):
+            for material, piece in __merge_pieces(key, geometry, color_code).items():
+                pieces.setdefault(material, []).append((piece, matrix, part_index, filename, certified))
+
+        group_name = "merged"
+        if collection is not None:
+            group_name = collection.name
+
+        for material, material_pieces in pieces.items():
+            name = group_name
+            if material is not None:
+                name = f"{group_name}_{material.name}"
+
+            mesh = create_merged_mesh(name, material_pieces, use_smooth=material is not None and options.shade_smooth)
+            if material is not None:
+                mesh.materials.append(material)
+                apply_merged_slope_material(mesh, material, material_pieces)
+
+            if options.merged_part_ids:
+                part_indices = np.concatenate([np.full(len(piece[1]), part_index, dtype=np.int32) for piece, _, part_index, _, _ in material_pieces])
+                layer = mesh.polygon_layers_int.new(name=strings.ldraw_part_key)
+                layer.data.foreach_set("value", part_indices)
+                mesh[strings.ldraw_part_key] = [filename for _, _, _, _, filename, _ in parts]
+
+            obj = bpy.data.objects.new(name, mesh)
+            if in_instance:
+                obj.matrix_world = matrices.identity
+            elif top_empty is None:
+                obj.matrix_world = matrices.scaled_matrix(options.import_scale) @ matrices.rotation
+            else:
+                obj.parent = top_empty
+
+            if frame is not None:
+                keyframe_step(obj, frame)
+
+            add_modifiers(obj)
+
+            if collection is not None:
+                collection.objects.link(obj)
+            else:
+                bpy.context.scene.collection.objects.link(obj)
+
+
+# one mesh of pieces, each the faces of a part in one material moved by its matrix
+# written with foreach_set, edges are added with their sharp flags and bevel weights before the rest are calculated from the faces
+# faces of a part placed with a mirroring matrix are reversed like LDrawGeometry.append does
+# normals are recalculated only for the faces of parts that aren't certified, like bmesh_ops does
+# the pieces come from valid faces, so like in do_create_mesh only a matrix that isn't finite needs mesh.validate()
+def create_merged_mesh(name, pieces, use_smooth):
+    vertices = []
+    face_totals = []
+    loop_vertices = []
+    edges = []
+    use_edge_sharp = []
+    recalculate = []
+
+    vertex_count = 0
+    for (piece_vertices, piece_totals, piece_loop_vertices, piece_edges, piece_is_sharp), matrix, _, _, certified in pieces:
+        if np.linalg.det(matrix[:3, :3]) < 0:
+            piece_loop_vertices = piece_loop_vertices[reversed_face_order(piece_totals)]
+        vertices.append(piece_vertices @ matrix[:3, :3].T + matrix[:3, 3])
+        face_totals.append(piece_totals)
+        loop_vertices.append(piece_loop_vertices + vertex_count)
+        edges.append(piece_edges + vertex_count)
+        use_edge_sharp.append(piece_is_sharp)
+        recalculate.append(np.full(len(piece_totals), not certified))
+        vertex_count += len(piece_vertices)
+
+    vertices = np.concatenate(vertices)
+    face_totals = np.concatenate(face_totals)
+    loop_vertices = np.concatenate(loop_vertices)
+    edges = np.concatenate(edges)
+    use_edge_sharp = np.concatenate(use_edge_sharp)
+    recalculate = np.concatenate(recalculate)
+
+    mesh = bpy.data.meshes.new(name)
+    set_mesh_vertices(mesh, vertices)
+    mesh.edges.add(len(edges))
+    mesh.edges.foreach_set("vertices", edges.astype(np.int32).ravel())
+    mesh.edges.foreach_set("use_edge_sharp", use_edge_sharp)
+    if options.bevel_edges:
+        mesh.use_customdata_edge_bevel = True
+        mesh.edges.foreach_set("bevel_weight", use_edge_sharp.astype(np.float32))
+    mesh.loops.add(len(loop_vertices))
+    mesh.loops.foreach_set("vertex_index", loop_vertices)
+    mesh.polygons.add(len(face_totals))
+    mesh.polygons.foreach_set("loop_start", (np.cumsum(face_totals) - face_totals).astype(np.int32))
+    mesh.polygons.foreach_set("loop_total", face_totals)
+    mesh.polygons.foreach_set("use_smooth", np.full(len(face_totals), use_smooth))
+    mesh.update(calc_edges=True)
+    if needs_validate(vertices, face_totals):
+        mesh.validate()
+
+    if options.recalculate_normals and np.any(recalculate):
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
+
+        faces = bm.faces[:]
+        if len(faces) == len(recalculate):
+            faces = [faces[i] for i in np.flatnonzero(recalculate).tolist()]
+        bmesh.ops.recalc_face_normals(bm, faces=faces)
+
+        bm.to_mesh(mesh)
+
+        bm.clear()
+        bm.free()
+
+    if options.smooth_type == "auto_smooth":
+        mesh.use_auto_smooth = options.shade_smooth
+        mesh.auto_smooth_angle = math.radians(89.9)  # 1.56905 - 89.9 so 90 degrees and up are affected
+
+    return mesh
+
+
+# apply_slope_materials for a merged mesh of one material, the faces of slope parts get the slope version of material
+# their normals are taken back into the space of their part, which is where the slope angles are measured
+def apply_merged_slope_material(mesh, material, pieces):
+    if strings.ldraw_color_code_key not in material:
+        return
+    if not any(filename in special_bricks.slope_angles for _, _, _, filename, _ in pieces):
+        return
+
+    normals = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+    mesh.polygons.foreach_get("normal", normals)
+    normals = normals.reshape(-1, 3).astype(np.float64)
+
+    is_slope = np.zeros(len(normals), dtype=bool)
+    start = 0
+    for piece, matrix, _, filename, _ in pieces:
+        end = start + len(piece[1])
+        slope_angles = special_bricks.slope_angles.get(filename)
+        if slope_angles is not None and end <= len(normals):
+            part_normals = normals[start:end] @ matrix[:3, :3]
+            lengths = np.maximum(np.linalg.norm(part_normals, axis=1), 1e-12)
+            angles = np.degrees(np.arccos(np.clip(part_normals[:, 1] / lengths, -1.0, 1.0))) - 90
+            for low, high in slope_angles:
+                is_slope[start:end] |= (low <= angles) & (angles <= high)
+        start = end
+
+    if not np.any(is_slope):
+        return
+
+    color = ldraw_colors.get_color(str(material[strings.ldraw_color_code_key]))
+    slope_material = blender_materials.get_material(color, is_slope_material=True)
+    if slope_material is None:
+        return
+
+    mesh.materials.append(slope_material)
+    mesh.polygons.foreach_set("material_index", is_slope.astype(np.int32))
+
+
+# with options.instance_studs the studs of every part placed in a collection are gathered into one carrier
+# object per stud file and color, with a triangle for each stud, and the stud mesh as a child instanced on its faces
+# matrix places the part the studs belong to, studs that inherit their color take color_code
+def add_studs(studs, matrix, color_code, collection):
+    m = np.array(matrix, dtype=np.float64)
+    # gaps scale each part around its origin, whichever way they are made
+    if options.make_gaps:
+        m = m @ np.array(matrices.scaled_matrix(options.gap_scale), dtype=np.float64)
+
+    for ldraw_file, stud_color_code, stud_matrix in studs:
+        if stud_color_code == 16:
+            stud_color_code = helpers.color_code_to_int(color_code)
+
+        key = (collection, ldraw_file, stud_color_code)
+        carrier = stud_carriers.get(key)
+        if carrier is None:
+            carrier = (building_instance, [])
+            stud_carriers[key] = carrier
+        carrier[1].append(m @ stud_matrix)
+
+
+# builds the carriers gathered by add_studs, once everything has been loaded
+def create_stud_instances():
+    for (collection, ldraw_file, color_code), (in_instance, stud_matrices) in stud_carriers.items():
+        stud_mesh = get_stud_mesh(ldraw_file, helpers.int_to_color_code(color_code))
+
+        carrier_name = f"studs_{stud_mesh.name}"
+        carrier_mesh = create_mesh(carrier_name, stud_faces(np.array(stud_matrices)))
+        carrier = bpy.data.objects.new(carrier_name, carrier_mesh)
+        carrier.instance_type = "FACES"
+        carrier.use_instance_faces_scale = True
+        carrier.instance_faces_scale = 1.0
+        carrier.show_instancer_for_viewport = False
+        carrier.show_instancer_for_render = False
+
+        if in_instance:
+            carrier.matrix_world = matrices.identity
+        elif top_empty is None:
+            carrier.matrix_world = matrices.scaled_matrix(options.import_scale) @ matrices.rotation
+        else:
+            carrier.parent = top_empty
+
+        stud = bpy.data.objects.new(stud_mesh.name, stud_mesh)
+        stud[strings.ldraw_filename_key] = ldraw_file.name
+        add_modifiers(stud)
+        stud.parent = carrier
+
+        if collection is None:
+            collection = bpy.context.scene.collection
+        collection.objects.link(carrier)
+        collection.objects.link(stud)
+
+        # the stud itself would show at the origin of the carrier, its instances still do when it is hidden
+        # objects in an instanced submodel aren't in the view layer, the collection instance hides them instead
+        if stud.name in bpy.context.view_layer.objects:
+            stud.hide_set(True)
+
+
+# a triangle for each matrix that face instancing turns back into that matrix
+# the instance is rotated so its z axis is the face normal and its x axis points from the first vertex to the second
+# and scaled by the square root of the face area, so a mirrored stud is flipped on x and a scaled one is scaled evenly
+def stud_faces(stud_matrices):
+    rotations = stud_matrices[:, :3, :3]
+    determinants = np.linalg.det(rotations)
+    scales = np.cbrt(np.abs(determinants))
+
+    u, _, vt = np.linalg.svd(rotations)
+    rotations = u @ vt
+    rotations[np.linalg.det(rotations) < 0, :, 0] *= -1
+
+    # legs of length l give an area of l * l / 2
+    legs = (scales * math.sqrt(2.0))[:, np.newaxis]
+    x = rotations[:, :, 0] * legs
+    y = rotations[:, :, 1] * legs
+
+    # the face is centered on the stud
+    v0 = stud_matrices[:, :3, 3] - (x + y) / 3.0
+
+    geometry = LDrawGeometry()
+    geometry.vertices = np.stack([v0, v0 + x, v0 + y], axis=1).reshape(-1, 3)
+    geometry.faces = np.full(len(stud_matrices), 3, dtype=np.int32)
+    return geometry
+
+
+def get_stud_mesh(ldraw_file, color_code):
+    key = (options.fingerprint, color_code, ldraw_file.name, False)
+    mesh = mesh_cache.get(key)
+    if mesh is not None:
+        return mesh
+
+    name = mesh_name(key)
+    if name not in bpy.data.meshes:
+        subtree = get_subtree(ldraw_file, color_code, True, False)
+        geometry = LDrawGeometry()
+        geometry.allocate(*count_geometry(ldraw_file))
+        geometry.append_subtree(subtree, matrices.identity, helpers.color_code_to_int(color_code))
+        geometry.append_edges(subtree, matrices.identity)
+
+        mesh, face_indices = create_part_mesh(name, geometry)
+        apply_materials(mesh, geometry, face_indices)
+        bmesh_ops(mesh, geometry, is_certified(ldraw_file))
+
+        if options.smooth_type == "auto_smooth":
+            mesh.use_auto_smooth = options.shade_smooth
+            mesh.auto_smooth_angle = math.radians(89.9)
+        mesh[strings.ldraw_filename_key] = ldraw_file.name
+    mesh = bpy.data.meshes[name]
+    mesh_cache[key] = mesh
+    return mesh
+
+
+# hides obj until frame
+def keyframe_step(obj, frame):
+    if options.debug_text:
+        print(current_step)
+
+    bpy.context.scene.frame_set(options.starting_step_frame)
+    obj.hide_viewport = True
+    obj.hide_render = True
+    obj.keyframe_insert(data_path="hide_render")
+    obj.keyframe_insert(data_path="hide_viewport")
+
+    bpy.context.scene.frame_set(frame)
+    obj.hide_viewport = False
+    obj.hide_render = False
+    obj.keyframe_insert(data_path="hide_render")
+    obj.keyframe_insert(data_path="hide_viewport")
+
+    if options.debug_text:
+        print(frame)
 
 
 # https://youtu.be/cQ0qtcSymDI?t=356
@@ -181,37 +1080,172 @@ def create_object(mesh, parent_matrix, matrix):
 # f = [f1, f2, f3]
 # for f in enumerate(faces):
 #     this_vert = bm.verts.new(f)
-def do_create_mesh(key, geometry_vertices, geometry_faces):
-    vertices = [v.to_tuple() for v in geometry_vertices]
-    edges = []
-    faces = []
-
-    # makes indexes sequential
-    face_index = 0
-    for f in geometry_faces:
-        new_face = []
-        for _ in range(f):
-            new_face.append(face_index)
-            face_index += 1
-        faces.append(new_face)
-
-    # add materials before doing from_pydata step
+# the arrays are written straight into the mesh with foreach_set instead of going through python lists
+# without loop_vertices faces use their vertices in order, with it faces use loop_vertices in order
+# either way indices can't be out of range or repeated within a face
+# that leaves only faces with fewer than 3 vertices or vertices that aren't finite for mesh.validate() to fix
+def do_create_mesh(key, geometry_vertices, geometry_faces, loop_vertices=None):
     mesh = bpy.data.meshes.new(key)
-    mesh.from_pydata(vertices, edges, faces)
-    mesh.validate()
+    set_mesh_vertices(mesh, geometry_vertices)
+
+    if loop_vertices is None:
+        loop_vertices = np.arange(len(geometry_vertices), dtype=np.int32)
+    mesh.loops.add(len(loop_vertices))
+    mesh.loops.foreach_set("vertex_index", loop_vertices.astype(np.int32))
+
+    mesh.polygons.add(len(geometry_faces))
+    mesh.polygons.foreach_set("loop_start", (np.cumsum(geometry_faces) - geometry_faces).astype(np.int32))
+    mesh.polygons.foreach_set("loop_total", geometry_faces)
+
+    if needs_validate(geometry_vertices, geometry_faces):
+        mesh.validate()
     mesh.update(calc_edges=True)
 
     return mesh
 
 
+def needs_validate(vertices, faces):
+    return not np.all(faces >= 3) or not np.all(np.isfinite(vertices))
+
+
+def set_mesh_vertices(mesh, vertices):
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set("co", vertices.astype(np.float32).ravel())
+
+
+# each edge line joins its vertices in order, there are no faces
 def create_edge_mesh(key, geometry):
-    return do_create_mesh(key, geometry.edge_vertices, geometry.edges)
+    mesh = bpy.data.meshes.new(key)
+    set_mesh_vertices(mesh, geometry.edge_vertices)
+
+    # every vertex but the last of each line starts an edge to the next one
+    starts_edge = np.ones(len(geometry.edge_vertices), dtype=bool)
+    starts_edge[np.cumsum(geometry.edges) - 1] = False
+    first = np.flatnonzero(starts_edge).astype(np.int32)
+
+    mesh.edges.add(len(first))
+    mesh.edges.foreach_set("vertices", np.stack([first, first + 1], axis=1).ravel())
+
+    if not np.all(np.isfinite(geometry.edge_vertices)):
+        mesh.validate()
+    mesh.update()
+
+    return mesh
 
 
 def create_mesh(key, geometry):
     return do_create_mesh(key, geometry.vertices, geometry.faces)
 
 
+# the mesh of a part and the index in geometry of each of its faces
+# with options.remove_doubles vertices are welded before the mesh is built
+# geometry with vertices that aren't finite is left as it is for mesh.validate()
+def create_part_mesh(key, geometry):
+    if not options.remove_doubles or not np.all(np.isfinite(geometry.vertices)):
+        return create_mesh(key, geometry), np.arange(len(geometry.faces))
+
+    vertices, loop_vertices, faces, face_indices = weld_vertices(geometry.vertices, geometry.faces, options.merge_distance)
+    return do_create_mesh(key, vertices, faces, loop_vertices), face_indices
+
+
+# welds vertices within distance of each other the way bmesh.ops.remove_doubles does
+# vertices are visited in order of the sum of their coordinates and each one that hasn't been welded yet
+# takes the vertices after it within distance that haven't either
+# faces drop loops that end up on the same vertex as the loop before them, faces left with fewer than 3 vertices,
+# faces that use a vertex twice and faces that use the same vertices as a face before them are removed
+# returns (vertices, loop vertex indices, face sizes, index in faces of each face kept)
+def weld_vertices(vertices, faces, distance):
+    vertex_count = len(vertices)
+    if vertex_count < 1:
+        return vertices, np.empty(0, dtype=np.int32), faces, np.arange(len(faces))
+
+    # every copy of a position ends up where its first copy does, so only the first copies are searched
+    copy_order = np.lexsort(vertices.T[::-1])
+    sorted_vertices = vertices[copy_order]
+    is_first = np.ones(vertex_count, dtype=bool)
+    is_first[1:] = np.any(sorted_vertices[1:] != sorted_vertices[:-1], axis=1)
+    first_copies = np.empty(vertex_count, dtype=np.int64)
+    first_copies[copy_order] = copy_order[is_first][np.cumsum(is_first) - 1]
+    positions = np.flatnonzero(first_copies == np.arange(vertex_count))
+    targets = positions[__weld_targets(vertices[positions], distance)[np.searchsorted(positions, first_copies)]]
+
+    is_kept = targets == np.arange(vertex_count)
+    new_indices = np.cumsum(is_kept) - 1
+    loop_vertices = new_indices[targets]
+
+    # loops on the same vertex as the loop before them in their face are dropped
+    face_count = len(faces)
+    starts = np.cumsum(faces) - faces
+    face_of_loop = np.repeat(np.arange(face_count), faces)
+    previous_loops = np.arange(len(loop_vertices)) - 1
+    previous_loops[starts] = starts + faces - 1
+    kept_loops = loop_vertices != loop_vertices[previous_loops]
+    # a face with every loop on one vertex keeps one of them
+    kept_loops[starts[np.bincount(face_of_loop, weights=kept_loops, minlength=face_count) == 0]] = True
+    loop_vertices = loop_vertices[kept_loops]
+    face_of_loop = face_of_loop[kept_loops]
+    new_faces = np.bincount(face_of_loop, minlength=face_count)
+
+    kept_faces = new_faces >= 3
+    if np.any(kept_faces):
+        # faces are compared by their sorted vertices, later copies of a face are dropped
+        size = int(np.max(new_faces))
+        new_starts = np.cumsum(new_faces) - new_faces
+        columns = np.arange(len(loop_vertices)) - new_starts[face_of_loop]
+        face_vertices = np.full((face_count, size), -1, dtype=np.int64)
+        face_vertices[face_of_loop, columns] = loop_vertices
+        face_vertices.sort(axis=1)
+        kept_faces &= ~np.any((face_vertices[:, 1:] == face_vertices[:, :-1]) & (face_vertices[:, 1:] >= 0), axis=1)
+        face_order = np.lexsort(face_vertices.T[::-1])
+        sorted_vertices = face_vertices[face_order]
+        is_copy = np.zeros(face_count, dtype=bool)
+        is_copy[face_order[1:]] = np.all(sorted_vertices[1:] == sorted_vertices[:-1], axis=1)
+        kept_faces &= ~is_copy
+
+    face_indices = np.flatnonzero(kept_faces)
+    loop_vertices = loop_vertices[kept_faces[face_of_loop]]
+    return vertices[is_kept], loop_vertices.astype(np.int32), new_faces[face_indices].astype(np.int32), face_indices
+
+
+# the index of the vertex each vertex is welded to, its own index for the vertices that are kept
+def __weld_targets(vertices, distance):
+    vertex_count = len(vertices)
+    order = np.argsort(vertices.sum(axis=1), kind="stable")
+    rank = np.empty(vertex_count, dtype=np.int64)
+    rank[order] = np.arange(vertex_count)
+
+    # pairs of a vertex and a vertex before it within distance
+    near_from, near_to = __vertices_near(vertices, vertices, distance)
+    before = rank[near_to] < rank[near_from]
+    near_from = near_from[before]
+    near_to = near_to[before]
+
+    # a vertex is welded to the first kept vertex before it within distance and kept if there is none
+    # it is settled once every vertex before that one within distance is, which takes a few passes
+    # along chains of vertices within distance of each other
+    targets = np.full(vertex_count, -1, dtype=np.int64)
+    unsettled = np.ones(vertex_count, dtype=bool)
+    while np.any(unsettled):
+        pending = unsettled[near_from]
+        near_from = near_from[pending]
+        near_to = near_to[pending]
+
+        is_unsettled = unsettled[near_to]
+        is_kept = ~is_unsettled & (targets[near_to] == near_to)
+        first_kept = np.full(vertex_count, vertex_count, dtype=np.int64)
+        np.minimum.at(first_kept, near_from[is_kept], rank[near_to[is_kept]])
+        first_unsettled = np.full(vertex_count, vertex_count, dtype=np.int64)
+        np.minimum.at(first_unsettled, near_from[is_unsettled], rank[near_to[is_unsettled]])
+
+        welded = unsettled & (first_kept < first_unsettled)
+        targets[welded] = order[first_kept[welded]]
+        kept = unsettled & (first_kept == vertex_count) & (first_unsettled == vertex_count)
+        targets[kept] = np.flatnonzero(kept)
+        unsettled &= ~(welded | kept)
+
+    return targets
+
+
 # https://blender.stackexchange.com/a/91687
 # for f in bm.faces:
 #     f.smooth = True
@@ -222,87 +1256,170 @@ def create_mesh(key, geometry):
 # mesh.polygons.foreach_set("use_smooth", values)
 # bpy.context.object.active_material.use_backface_culling = True
 # bpy.context.object.active_material.use_screen_refraction = True
-def apply_materials(mesh, geometry):
-    for i, f in enumerate(mesh.polygons):
-        face_info = geometry.face_info[i]
-
-        grain_slope_allowed = face_info.grain_slope_allowed
-
-        color_code = face_info.color_code
-        color = ldraw_colors.get_color(color_code)
-
-        use_edge_color = face_info.use_edge_color
-        material = blender_materials.get_material(color, use_edge_color=use_edge_color)
+# colors are looked up once for each color code and edge color flag in the mesh, in the order they first appear
+# which gives the material slots, then material_index and use_smooth are written for every face at once
+# faces whose color has no material keep slot 0 and aren't smoothed
+# face_indices is the index in geometry of each face of the mesh, when they aren't the same
+def apply_materials(mesh, geometry, face_indices=None):
+    face_count = len(mesh.polygons)
+    if face_indices is None:
+        face_indices = np.arange(face_count)
+    face_indices = face_indices[:face_count]
+    face_keys = np.stack([geometry.face_color_codes[face_indices], geometry.face_use_edge_color[face_indices]], axis=1).astype(np.int64)
+    keys, first_faces, face_key_indices = np.unique(face_keys, axis=0, return_index=True, return_inverse=True)
+    face_key_indices = face_key_indices.reshape(-1)
+
+    # key index => slot index, -1 for colors without a material
+    key_slots = np.full(len(keys), -1, dtype=np.int32)
+    for key_index in np.argsort(first_faces).tolist():
+        color_code, use_edge_color = keys[key_index].tolist()
+        color = ldraw_colors.get_color(helpers.int_to_color_code(color_code))
+        material = blender_materials.get_material(color, use_edge_color=bool(use_edge_color))
         if material is None:
             continue
 
         if material.name not in mesh.materials:
             mesh.materials.append(material)
-        f.material_index = mesh.materials.find(material.name)
+        key_slots[key_index] = mesh.materials.find(material.name)
+
+    face_slots = key_slots[face_key_indices]
+    has_material = face_slots >= 0
 
-        f.use_smooth = options.shade_smooth
+    mesh.polygons.foreach_set("material_index", np.maximum(face_slots, 0))
+    mesh.polygons.foreach_set("use_smooth", has_material & options.shade_smooth)
 
 
-def bmesh_ops(mesh, geometry):
+# certified is whether the faces of mesh are all certified, see is_certified
+def bmesh_ops(mesh, geometry, certified=False):
     if options.bevel_edges:
         mesh.use_customdata_edge_bevel = True
 
-    bm = bmesh.new()
-    bm.from_mesh(mesh)
+    # vertices are welded by create_part_mesh, bmesh is only needed to recalculate normals
+    if options.recalculate_normals and not certified:
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
 
-    bm.faces.ensure_lookup_table()
-    bm.verts.ensure_lookup_table()
-    bm.edges.ensure_lookup_table()
+        bmesh.ops.recalc_face_normals(bm, faces=bm.faces[:])
 
-    if options.remove_doubles:
-        bmesh.ops.remove_doubles(bm, verts=bm.verts[:], dist=options.merge_distance)
+        bm.to_mesh(mesh)
 
-    # Find layer for bevel weights
-    bevel_weight_layer = None
-    if options.bevel_edges:
-        if 'BevelWeight' in bm.edges.layers.bevel_weight:
-            bevel_weight_layer = bm.edges.layers.bevel_weight["BevelWeight"]
+        bm.clear()
+        bm.free()
 
-    if options.recalculate_normals:
-        bmesh.ops.recalc_face_normals(bm, faces=bm.faces[:])
+    mark_sharp_edges(mesh, geometry)
+
+
+# the offsets from a cell of a grid to the cells next to it along each axis, diagonals included
+cell_offsets = np.array([(x, y, z) for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.int64)
+
+
+# edge lines are pairs of vertices in geometry.edge_vertices
+# a mesh edge is made sharp, and given a bevel weight with options.bevel_edges, when one of its vertices
+# is within options.merge_distance of one end of an edge line and the other vertex is within it of the other end
+def mark_sharp_edges(mesh, geometry):
+    edge_count = len(mesh.edges)
+    if edge_count < 1 or len(geometry.edge_vertices) < 2:
+        return
+
+    vertices = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", vertices)
+    vertices = vertices.reshape(-1, 3).astype(np.float64)
+
+    edges = np.empty(edge_count * 2, dtype=np.int32)
+    mesh.edges.foreach_get("vertices", edges)
+    is_sharp = sharp_edges(vertices, edges.reshape(-1, 2), geometry)
 
-    # Create kd tree for fast "find nearest points" calculation
-    kd = mathutils.kdtree.KDTree(len(bm.verts))
-    for i, v in enumerate(bm.verts):
-        kd.insert(v.co, i)
-    kd.balance()
-    # Create edgeIndices dictionary, which is the list of edges as pairs of indicies into our bm.verts array
-    edge_indices = {}
-    for i in range(0, len(geometry.edge_vertices), 2):
-        edges0 = [index for (co, index, dist) in kd.find_range(geometry.edge_vertices[i + 0], options.merge_distance)]
-        edges1 = [index for (co, index, dist) in kd.find_range(geometry.edge_vertices[i + 1], options.merge_distance)]
-
-        for e0 in edges0:
-            for e1 in edges1:
-                edge_indices[(e0, e1)] = True
-                edge_indices[(e1, e0)] = True
-
-    # Find the appropriate mesh edges and make them sharp (i.e. not smooth)
-    for edge_vertex in bm.edges:
-        v0 = edge_vertex.verts[0].index
-        v1 = edge_vertex.verts[1].index
-        if (v0, v1) in edge_indices:
-            # Make edge sharp
-            edge_vertex.smooth = False
-
-            # Add bevel weight
-            if bevel_weight_layer is not None:
-                bevel_wight = 1.0
-                edge_vertex[bevel_weight_layer] = bevel_wight
-
-    bm.faces.ensure_lookup_table()
-    bm.verts.ensure_lookup_table()
-    bm.edges.ensure_lookup_table()
-
-    bm.to_mesh(mesh)
-
-    bm.clear()
-    bm.free()
+    use_edge_sharp = np.empty(edge_count, dtype=bool)
+    mesh.edges.foreach_get("use_edge_sharp", use_edge_sharp)
+    mesh.edges.foreach_set("use_edge_sharp", use_edge_sharp | is_sharp)
+
+    if options.bevel_edges:
+        bevel_weights = np.empty(edge_count, dtype=np.float32)
+        mesh.edges.foreach_get("bevel_weight", bevel_weights)
+        bevel_weights[is_sharp] = 1.0
+        mesh.edges.foreach_set("bevel_weight", bevel_weights)
+
+
+# whether each of edges, unique pairs of indices into vertices, lies along an edge line, see mark_sharp_edges
+# vertices are compared at the precision blender stores coordinates in
+# the vertex pairs found for every edge line are joined with the edges in one pass
+def sharp_edges(vertices, edges, geometry):
+    edge_count = len(edges)
+    is_sharp = np.zeros(edge_count, dtype=bool)
+    if edge_count < 1 or len(geometry.edge_vertices) < 2:
+        return is_sharp
+
+    line_ends = geometry.edge_vertices[:len(geometry.edge_vertices) // 2 * 2].astype(np.float32).astype(np.float64)
+    end_indices, end_vertices = __vertices_near(line_ends, vertices, options.merge_distance)
+
+    # every vertex near the first end of a line is paired with every vertex near its second end
+    end_counts = np.bincount(end_indices, minlength=len(line_ends))
+    end_starts = np.cumsum(end_counts) - end_counts
+    first = np.flatnonzero(end_indices % 2 == 0)
+    second_ends = end_indices[first] + 1
+    pair_counts = end_counts[second_ends]
+    pair_offsets = np.arange(np.sum(pair_counts)) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    second = np.repeat(end_starts[second_ends], pair_counts) + pair_offsets
+    first = np.repeat(first, pair_counts)
+
+    vertex_count = len(vertices)
+    line_keys = __edge_keys(end_vertices[first], end_vertices[second], vertex_count)
+    edge_keys = __edge_keys(edges[:, 0], edges[:, 1], vertex_count)
+
+    # edges are unique, so each vertex pair is found at most once in the sorted edge keys
+    edge_order = np.argsort(edge_keys)
+    found = np.minimum(np.searchsorted(edge_keys[edge_order], line_keys), edge_count - 1)
+    found = found[edge_keys[edge_order[found]] == line_keys]
+    is_sharp[edge_order[found]] = True
+    return is_sharp
+
+
+# the same key for an edge either way around
+def __edge_keys(v0, v1, vertex_count):
+    v0 = v0.astype(np.int64)
+    v1 = v1.astype(np.int64)
+    return np.minimum(v0, v1) * vertex_count + np.maximum(v0, v1)
+
+
+# (point indices, vertex indices) of the vertices within distance of each point, ordered by point
+# vertices are sorted by the cell they are in of a grid a little over twice distance wide
+# so the vertices near a point are in its cell or the 7 cells toward the corner of its cell it is closest to
+def __vertices_near(points, vertices, distance):
+    # no more than 2 ** 20 cells along each axis, so cell keys fit in an int64
+    extent = float(np.max(vertices.max(axis=0) - vertices.min(axis=0)))
+    cell_size = max(distance * 2.01, extent / 2 ** 20, 1e-6)
+    vertex_cells = np.floor(vertices / cell_size).astype(np.int64)
+    point_cells = points / cell_size
+    point_corners = np.where(point_cells - np.floor(point_cells) < 0.5, -1, 1)
+    point_cells = np.floor(point_cells).astype(np.int64)
+
+    # cells are numbered row by row in a grid one cell larger on every side than the vertices need,
+    # cells of points outside of it can't have vertices and get -1
+    low = vertex_cells.min(axis=0) - 1
+    size = vertex_cells.max(axis=0) + 2 - low
+    vertex_keys = __cell_keys(vertex_cells - low, size)
+    query_cells = point_cells[:, np.newaxis] + cell_offsets * point_corners[:, np.newaxis] - low
+    query_keys = np.where(np.all((query_cells >= 0) & (query_cells < size), axis=2), __cell_keys(query_cells, size), -1).reshape(-1)
+
+    # the vertices of a cell are one run of cell_order
+    cell_keys, cell_counts = np.unique(vertex_keys, return_counts=True)
+    cell_order = np.argsort(vertex_keys, kind="stable")
+    cell_starts = np.cumsum(cell_counts) - cell_counts
+
+    cells = np.minimum(np.searchsorted(cell_keys, query_keys), len(cell_keys) - 1)
+    counts = np.where(cell_keys[cells] == query_keys, cell_counts[cells], 0)
+
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    candidate_vertices = cell_order[np.repeat(cell_starts[cells], counts) + offsets]
+    candidate_points = np.repeat(np.arange(len(query_keys)) // len(cell_offsets), counts)
+
+    difference = vertices[candidate_vertices] - points[candidate_points]
+    is_near = np.einsum("ij,ij->i", difference, difference) <= distance * distance
+    return candidate_points[is_near], candidate_vertices[is_near]
+
+
+def __cell_keys(cells, size):
+    return (cells[..., 0] * size[1] + cells[..., 1]) * size[2] + cells[..., 2]
 
 
 def create_gp_mesh(key, mesh):
@@ -346,16 +1463,36 @@ def apply_gp_materials(gp_mesh):
     gp_mesh.materials.append(material)
 
 
+visit_frame = 0
+finish_frame = 1
+
+
 class LDrawNode:
-    def __init__(self, file, color_code="16", matrix=matrices.identity):
+    def __init__(self, file, color_code="16", matrix=matrices.identity, invert=False):
         self.file = file
         self.color_code = color_code
         self.matrix = matrix
+        # referenced after 0 BFC INVERTNEXT
+        self.invert = invert
         self.top = False
         self.meta_command = None
         self.meta_args = {}
 
-    def load(self, parent_matrix=matrices.identity, parent_color_code="16", geometry=None, is_stud=False, is_edge_logo=False, parent_collection=None):
+    # walks the tree below this node depth first with an explicit stack instead of recursing
+    # a frame is (visit_frame, node, parent_matrix, parent_color_code, geometry, is_stud, is_edge_logo, is_inverted, parent_collection)
+    # or (finish_frame, node, parent_matrix, parent_color_code, mesh_color_code, key, geometry, file_collection)
+    # a finish frame is pushed under the children of a part so its mesh is made once they have all been flattened into it
+    # is_inverted is whether 0 BFC INVERTNEXT applies to the node an odd number of times between it and its part
+    def load(self, parent_matrix=matrices.identity, parent_color_code="16", geometry=None, is_stud=False, is_edge_logo=False, is_inverted=False, parent_collection=None):
+        stack = [(visit_frame, self, parent_matrix, parent_color_code, geometry, is_stud, is_edge_logo, is_inverted, parent_collection)]
+        while len(stack) > 0:
+            frame = stack.pop()
+            if frame[0] == visit_frame:
+                frame[1].visit(stack, *frame[2:])
+            else:
+                frame[1].finish_part(*frame[2:])
+
+    def visit(self, stack, parent_matrix, parent_color_code, geometry, is_stud, is_edge_logo, is_inverted, parent_collection):
         global current_step
         global top_collection
         global top_empty
@@ -409,25 +1546,13 @@ class LDrawNode:
         if self.color_code != "16":
             parent_color_code = self.color_code
 
-        key = []
-        key.append(options.resolution)
-        key.append(parent_color_code)
-        if options.display_logo:
-            key.append(options.chosen_logo)
-        if options.remove_doubles:
-            key.append("rd")
-        if options.smooth_type == "auto_smooth":
-            key.append("as")
-        if options.smooth_type == "edge_split":
-            key.append("es")
-        if options.use_alt_colors:
-            key.append("alt")
-        if options.add_subsurface:
-            key.append("ss")
-        if parent_color_code == "24":
-            key.append("edge")
-        key.append(self.file.name)
-        key = "_".join([k.lower() for k in key])
+        if geometry is not None and is_instanced_stud(self.file):
+            geometry.add_stud(self.file, parent_matrix @ self.matrix, helpers.color_code_to_int(parent_color_code))
+            return
+
+        # a part is built in its own coordinates, so only inversions from its own placement down apply to its faces
+        if geometry is not None:
+            is_inverted = is_inverted != self.invert
 
         is_model = self.file.part_type in ldraw_part_types.model_types
         is_part = self.file.part_type in ldraw_part_types.part_types
@@ -437,6 +1562,23 @@ class LDrawNode:
         matrix = parent_matrix @ self.matrix
         file_collection = parent_collection
 
+        # every submodel below the top model is built once and placed with an instance
+        # the steps of a submodel are counted each time it is placed, which building it once would skip
+        # a model referenced from a part is flattened into it, its faces were counted into the part's buffers
+        if is_model and geometry is None and options.instance_submodels and not options.meta_step and top_collection is not None:
+            if options.meta_group and not building_instance and next_collection is not None:
+                file_collection = next_collection
+                if end_next_collection:
+                    next_collection = None
+
+            instance_collection = get_instance_collection(self.file, parent_color_code)
+            obj = create_instance(instance_collection, parent_matrix, self.matrix, parent_color_code)
+            if file_collection is not None:
+                file_collection.objects.link(obj)
+            else:
+                bpy.context.scene.collection.objects.link(obj)
+            return
+
         if is_model:
             file_collection = bpy.data.collections.new(os.path.basename(self.file.filepath))
             if parent_collection is not None:
@@ -457,11 +1599,19 @@ class LDrawNode:
         elif geometry is None:
             geometry = LDrawGeometry()
             matrix = matrices.identity
+            is_inverted = self.invert
             self.top = True
             global part_count
             part_count += 1
 
-        if options.meta_group and next_collection is not None:
+        # with shared part meshes a part is built in color 16 and its color is set on each object instead
+        mesh_color_code = parent_color_code
+        if self.top and options.share_part_meshes and parent_color_code != "24":
+            mesh_color_code = "16"
+
+        key = (options.fingerprint, mesh_color_code, self.file.name, is_inverted)
+
+        if options.meta_group and not building_instance and next_collection is not None:
             file_collection = next_collection
             if end_next_collection:
                 next_collection = None
@@ -479,11 +1629,28 @@ class LDrawNode:
             print(self.file.name)
             print("===========")
 
+        if self.top and key not in geometry_cache:
+            session_geometry = session_cache.get_geometry(key)
+            if session_geometry is not None:
+                geometry_cache[key] = session_geometry
+
         # if it's a part and already in the cache, reuse it
         # meta commands are not in self.top files which is how they are counted
         if self.top and key in geometry_cache:
             geometry = geometry_cache[key]
+            stack.append((finish_frame, self, parent_matrix, parent_color_code, mesh_color_code, key, geometry, file_collection))
         else:
+            if self.top:
+                geometry.allocate(*count_geometry(self.file))
+                stack.append((finish_frame, self, parent_matrix, parent_color_code, mesh_color_code, key, geometry, file_collection))
+
+            if geometry is not None and not self.top and is_flattenable(self.file):
+                # the whole subtree is transformed and appended at once instead of walking it again
+                subtree = get_subtree(self.file, mesh_color_code, is_stud, is_edge_logo)
+                geometry.append_subtree(subtree, matrix, helpers.color_code_to_int(mesh_color_code), is_inverted)
+                geometry.append_edges(subtree, matrix)
+                return
+
             if geometry is not None:
                 if self.file.name in ["stud.dat", "stud2.dat"]:
                     is_stud = True
@@ -492,89 +1659,76 @@ class LDrawNode:
                 if self.file.name in ["logo.dat", "logo2.dat"]:
                     is_edge_logo = True
 
-                vertices = [matrix @ v for v in self.file.geometry.vertices]
-                geometry.vertices.extend(vertices)
+                geometry.append(
+                    self.file.geometry,
+                    matrix,
+                    helpers.color_code_to_int(mesh_color_code),
+                    use_edge_color=mesh_color_code == "24",
+                    grain_slope_allowed=not is_stud,
+                    is_inverted=is_inverted,
+                )
 
                 if (not is_edge_logo) or (is_edge_logo and options.display_logo):
-                    vertices = [matrix @ v for v in self.file.geometry.edge_vertices]
-                    geometry.edge_vertices.extend(vertices)
-
-                geometry.edges.extend(self.file.geometry.edges)
-                geometry.faces.extend(self.file.geometry.faces)
-
-                if key not in face_info_cache:
-                    new_face_info = []
-                    for face_info in self.file.geometry.face_info:
-                        copy = FaceInfo(color_code=parent_color_code, grain_slope_allowed=not is_stud)
-                        if parent_color_code == "24":
-                            copy.use_edge_color = True
-                        if face_info.color_code != "16":
-                            copy.color_code = face_info.color_code
-                        new_face_info.append(copy)
-                    face_info_cache[key] = new_face_info
-                new_face_info = face_info_cache[key]
-                geometry.face_info.extend(new_face_info)
-
-            for child in self.file.child_nodes:
-                child.load(parent_matrix=matrix,
-                           parent_color_code=parent_color_code,
-                           geometry=geometry,
-                           is_stud=is_stud,
-                           is_edge_logo=is_edge_logo,
-                           parent_collection=file_collection)
+                    geometry.append_edges(self.file.geometry, matrix)
 
-            if self.top:
-                geometry_cache[key] = geometry
-
-        if self.top:
-            if key not in bpy.data.meshes:
-                mesh = create_mesh(key, geometry)
-
-                # apply materials to mesh
-                # then mesh cleanup
-                # then apply slope materials
-                # this order is important because bmesh_ops causes
-                # mesh.polygons to get out of sync geometry.face_info
-                # which causes materials and slop materials to be applied incorrectly
-                apply_materials(mesh, geometry)  # combine with create_mesh
-                bmesh_ops(mesh, geometry)
-                apply_slope_materials(mesh, self.file.name)
-
-                if options.smooth_type == "auto_smooth":
-                    mesh.use_auto_smooth = options.shade_smooth
-                    mesh.auto_smooth_angle = math.radians(89.9)  # 1.56905 - 89.9 so 90 degrees and up are affected
-                if options.make_gaps and options.gap_target == "mesh":
-                    mesh.transform(matrices.scaled_matrix(options.gap_scale))
-                mesh[strings.ldraw_filename_key] = self.file.name
-            mesh = bpy.data.meshes[key]
-
-            if options.import_edges:
-                e_key = f"e_{key}"
-                if e_key not in bpy.data.meshes:
-                    edge_mesh = create_edge_mesh(e_key, geometry)
+            if geometry is not None and is_flattenable(self.file):
+                # no frame for each child when they can all be appended right away
+                append_child_subtrees(geometry, self.file, matrix, mesh_color_code, is_stud, is_edge_logo, is_inverted)
+            else:
+                # reversed so that children are visited in order
+                for child in reversed(self.file.child_nodes):
+                    stack.append((visit_frame, child, matrix, mesh_color_code, geometry, is_stud, is_edge_logo, is_inverted, file_collection))
+
+    def finish_part(self, parent_matrix, parent_color_code, mesh_color_code, key, geometry, file_collection):
+        if key not in geometry_cache:
+            geometry_cache[key] = geometry
+            session_cache.put_geometry(key, geometry, self.file)
+
+        if options.build_lods and key not in lod_parts:
+            lod_parts[key] = self.file
+
+        if options.import_edges:
+            edge_mesh = edge_mesh_cache.get(key)
+            if edge_mesh is None:
+                e_name = f"e_{mesh_name(key)}"
+                if e_name not in bpy.data.meshes:
+                    edge_mesh = create_edge_mesh(e_name, geometry)
                     edge_mesh[strings.ldraw_edge_key] = self.file.name
                     if options.make_gaps and options.gap_target == "mesh":
                         edge_mesh.transform(matrices.scaled_matrix(options.gap_scale))
-                edge_mesh = bpy.data.meshes[e_key]
-
-                if options.grease_pencil_edges:
-                    gp_mesh = create_gp_mesh(key, edge_mesh)
-                    apply_gp_materials(gp_mesh)
-                    gp_object = bpy.data.objects.new(key, gp_mesh)
-                    gp_object.matrix_world = parent_matrix @ self.matrix
-                    gp_object.active_material_index = len(gp_mesh.materials)
-
-                    collection_name = "Grease Pencil Edges"
-                    if collection_name not in bpy.context.scene.collection.children:
-                        collection = bpy.data.collections.new(collection_name)
-                        bpy.context.scene.collection.children.link(collection)
-                    collection = bpy.context.scene.collection.children[collection_name]
-                    collection.objects.link(gp_object)
-
+                edge_mesh = bpy.data.meshes[e_name]
+                edge_mesh_cache[key] = edge_mesh
+
+            if options.grease_pencil_edges:
+                gp_name = mesh_name(key)
+                gp_mesh = create_gp_mesh(gp_name, edge_mesh)
+                apply_gp_materials(gp_mesh)
+                gp_object = bpy.data.objects.new(gp_name, gp_mesh)
+                gp_object.matrix_world = parent_matrix @ self.matrix
+                gp_object.active_material_index = len(gp_mesh.materials)
+
+                collection_name = "Grease Pencil Edges"
+                if collection_name not in bpy.context.scene.collection.children:
+                    collection = bpy.data.collections.new(collection_name)
+                    bpy.context.scene.collection.children.link(collection)
+                collection = bpy.context.scene.collection.children[collection_name]
+                collection.objects.link(gp_object)
+
+        if options.merge_parts != "none":
+            # merged meshes are built from geometry, so there is no mesh for the part
+            add_merged_part(key, geometry, self.file, parent_color_code, parent_matrix @ self.matrix, file_collection)
+        else:
+            mesh = get_mesh(key, geometry, self.file)
             obj = create_object(mesh, parent_matrix, self.matrix)
             obj[strings.ldraw_filename_key] = self.file.name
 
+            if mesh_color_code != parent_color_code:
+                apply_object_materials(obj, key, parent_color_code)
+
             if file_collection is not None:
                 file_collection.objects.link(obj)
             else:
                 bpy.context.scene.collection.objects.link(obj)
+
+        if len(geometry.studs) > 0:
+            add_studs(geometry.studs, parent_matrix @ self.matrix, parent_color_code, file_collection)
@@ -6,6 +6,10 @@ from . import options
 from . import filesystem
 from . import ldraw_node
 from . import ldraw_import
+from . import ldraw_file
+from . import parse_cache
+from . import session_cache
+from . import hidden_faces
 from . import special_bricks
 
 
@@ -243,7 +247,105 @@ class IMPORT_OT_do_ldraw_import(bpy.types.Operator, ImportHelper):
 
     recalculate_normals: bpy.props.BoolProperty(
         name="Recalculate normals",
-        description="Recalculate normals",
+        description="Recalculate normals of parts that aren't BFC certified",
+        default=True
+    )
+
+    use_parse_cache: bpy.props.BoolProperty(
+        name="Cache parsed parts",
+        description="Keep parsed library parts on disk so later imports don't have to parse them again",
+        default=False
+    )
+
+    parse_cache_path: bpy.props.StringProperty(
+        name="Parse cache folder",
+        description="Where parsed parts are kept. Empty uses ldraw_parse_cache in the system temp folder",
+        default="",
+        subtype="DIR_PATH",
+    )
+
+    parse_cache_size: bpy.props.IntProperty(
+        name="Parse cache size (MB)",
+        description="Least recently used parts are deleted from the parse cache once it takes up more than this",
+        default=256,
+        min=1,
+        max=65536,
+    )
+
+    prefetch_threads: bpy.props.IntProperty(
+        name="Prefetch threads",
+        description="Read referenced files ahead of the parser with this many threads. Helps when the library is on slow or network storage. 0 disables it",
+        default=0,
+        min=0,
+        max=32,
+    )
+
+    parse_processes: bpy.props.IntProperty(
+        name="Parse processes",
+        description="Parse library files in this many worker processes. 0 parses everything in Blender's process",
+        default=0,
+        min=0,
+        max=64,
+    )
+
+    use_session_cache: bpy.props.BoolProperty(
+        name="Keep parts between imports",
+        description="Keep parsed and flattened parts in memory so later imports in this session can reuse them",
+        default=False
+    )
+
+    session_cache_size: bpy.props.IntProperty(
+        name="Session cache size (MB)",
+        description="Least recently used parts are dropped once the parts kept between imports take up more than this",
+        default=512,
+        min=1,
+        max=65536,
+    )
+
+    share_part_meshes: bpy.props.BoolProperty(
+        name="Share meshes between colors",
+        description="Build each part once and set its color on the object, so a part used in several colors shares one mesh",
+        default=False
+    )
+
+    instance_submodels: bpy.props.BoolProperty(
+        name="Instance submodels",
+        description="Build each submodel once per color and place every use of it as a collection instance. Not used with STEP",
+        default=False
+    )
+
+    instance_studs: bpy.props.BoolProperty(
+        name="Instance studs",
+        description="Leave studs out of part meshes and show them as instances of one stud mesh per color. Not used with STEP",
+        default=False
+    )
+
+    build_lods: bpy.props.BoolProperty(
+        name="Build LOD meshes",
+        description="Also build every part at the other resolutions so Object > Assign LDraw LOD can switch between them",
+        default=False
+    )
+
+    remove_hidden_faces: bpy.props.BoolProperty(
+        name="Remove hidden faces",
+        description="Remove faces that are enclosed by the parts around them, like studs inside the brick above. Not used with STEP",
+        default=False
+    )
+
+    merge_parts: bpy.props.EnumProperty(
+        name="Merge parts",
+        description="Join parts into one mesh per material instead of making an object for each part",
+        default="none",
+        items=(
+            ("none", "None", "Make an object for each part"),
+            ("collection", "Per collection", "Join the parts of each submodel and group collection"),
+            ("model", "Whole model", "Join all parts of the model"),
+        ),
+    )
+
+    merged_part_ids: bpy.props.BoolProperty(
+        name="Keep part ids",
+        description="Store which part each face of a merged mesh came from in the ldraw_part face layer",
         default=True
     )
 
@@ -283,6 +385,20 @@ class IMPORT_OT_do_ldraw_import(bpy.types.Operator, ImportHelper):
         options.prefer_unofficial = self.prefer_unofficial
         options.all_materials = self.all_materials
         options.recalculate_normals = self.recalculate_normals
+        options.use_parse_cache = self.use_parse_cache
+        options.parse_cache_path = bpy.path.abspath(self.parse_cache_path)
+        options.parse_cache_size = self.parse_cache_size
+        options.prefetch_threads = self.prefetch_threads
+        options.parse_processes = self.parse_processes
+        options.use_session_cache = self.use_session_cache
+        options.session_cache_size = self.session_cache_size
+        options.share_part_meshes = self.share_part_meshes
+        options.instance_submodels = self.instance_submodels
+        options.instance_studs = self.instance_studs
+        options.build_lods = self.build_lods
+        options.remove_hidden_faces = self.remove_hidden_faces
+        options.merge_parts = self.merge_parts
+        options.merged_part_ids = self.merged_part_ids
 
         ldraw_import.do_import(bpy.path.abspath(self.filepath))
 
@@ -290,6 +406,19 @@ class IMPORT_OT_do_ldraw_import(bpy.types.Operator, ImportHelper):
         print("======Import Complete======")
         print(self.filepath)
         print(f"Part count: {ldraw_node.part_count}")
+        if options.merge_parts != "none":
+            print(f"Merged parts: {ldraw_node.merged_part_count}")
+        if options.remove_hidden_faces:
+            print(f"Hidden faces removed: {hidden_faces.removed_triangles} triangles from {hidden_faces.reduced_objects} objects")
+        if options.instance_submodels and not options.meta_step:
+            print(f"Submodel instances: {ldraw_node.instance_count} built: {len(ldraw_node.instance_collection_cache)}")
+        if len(ldraw_file.missing_files) > 0:
+            print(f"Missing files: {len(ldraw_file.missing_files)}")
+        if options.use_parse_cache:
+            print(f"Parse cache hits: {parse_cache.hits} misses: {parse_cache.misses}")
+        print(f"Subtree cache hits: {ldraw_node.subtree_hits} misses: {ldraw_node.subtree_misses}")
+        if options.use_session_cache:
+            print(f"Session cache hits: {session_cache.hits} misses: {session_cache.misses}")
         end = time.monotonic()
         elapsed = (end - start)
         print(f"elapsed: {elapsed}")
@@ -311,8 +440,14 @@ class IMPORT_OT_do_ldraw_import(bpy.types.Operator, ImportHelper):
         box.label(text="Import Options")
         box.prop(self, "use_alt_colors")
         box.prop(self, "resolution", expand=True)
+        box.prop(self, "build_lods")
         box.prop(self, "display_logo")
         box.prop(self, "chosen_logo")
+        box.prop(self, "share_part_meshes")
+        box.prop(self, "instance_submodels")
+        box.prop(self, "instance_studs")
+        box.prop(self, "merge_parts")
+        box.prop(self, "merged_part_ids")
 
         box.label(text="Scaling Options")
         box.prop(self, "import_scale")
@@ -325,6 +460,7 @@ class IMPORT_OT_do_ldraw_import(bpy.types.Operator, ImportHelper):
         box.label(text="Cleanup Options")
         box.prop(self, "remove_doubles")
         box.prop(self, "merge_distance")
+        box.prop(self, "remove_hidden_faces")
         box.prop(self, "smooth_type")
         box.prop(self, "shade_smooth")
         box.prop(self, "recalculate_normals")
@@ -342,6 +478,13 @@ class IMPORT_OT_do_ldraw_import(bpy.types.Operator, ImportHelper):
 
         box.label(text="Extras")
         box.prop(self, "prefer_unofficial")
+        box.prop(self, "use_parse_cache")
+        box.prop(self, "parse_cache_path")
+        box.prop(self, "parse_cache_size")
+        box.prop(self, "prefetch_threads")
+        box.prop(self, "parse_processes")
+        box.prop(self, "use_session_cache")
+        box.prop(self, "session_cache_size")
         box.prop(self, "all_materials")
         box.prop(self, "add_subsurface")
         box.prop(self, "bevel_edges")
@@ -0,0 +1,127 @@
+import math
+import bpy
+import mathutils
+
+from . import strings
+
+
+# slots linked to the object, which give a shared part mesh its color, are matched to the slots of the new mesh
+# by the material of the mesh they override, the levels of a part don't have to list their materials in the same order
+def swap_mesh(obj, mesh):
+    object_materials = {}
+    for slot, mesh_material in zip(obj.material_slots, obj.data.materials):
+        if slot.link == "OBJECT" and mesh_material is not None:
+            object_materials[mesh_material.name] = slot.material
+
+    obj.data = mesh
+
+    for slot, mesh_material in zip(obj.material_slots, mesh.materials):
+        material = None
+        if mesh_material is not None:
+            material = object_materials.get(mesh_material.name)
+        if material is None:
+            slot.link = "DATA"
+        else:
+            slot.link = "OBJECT"
+            slot.material = material
+
+
+class OBJECT_OT_ldraw_assign_lod(bpy.types.Operator):
+    """Swap the mesh of each imported part for the resolution that suits how it is seen from the active camera"""
+    bl_idname = "object.ldraw_assign_lod"
+    bl_label = "Assign LDraw LOD"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    method: bpy.props.EnumProperty(
+        name="Method",
+        description="How the level of each part is chosen",
+        default="size",
+        items=(
+            ("size", "Projected size", "Use how much of the camera view the part covers"),
+            ("distance", "Distance", "Use how far the part is from the camera"),
+        ),
+    )
+
+    high_size: bpy.props.FloatProperty(
+        name="High above size",
+        description="Parts covering more than this fraction of the view use high resolution primitives",
+        default=0.1,
+        min=0.0,
+        max=1.0,
+    )
+
+    low_size: bpy.props.FloatProperty(
+        name="Low below size",
+        description="Parts covering less than this fraction of the view use low resolution primitives",
+        default=0.02,
+        min=0.0,
+        max=1.0,
+    )
+
+    high_distance: bpy.props.FloatProperty(
+        name="High within distance",
+        description="Parts closer than this use high resolution primitives",
+        default=10.0,
+        min=0.0,
+    )
+
+    low_distance: bpy.props.FloatProperty(
+        name="Low beyond distance",
+        description="Parts farther than this use low resolution primitives",
+        default=50.0,
+        min=0.0,
+    )
+
+    selection_only: bpy.props.BoolProperty(
+        name="Selection only",
+        description="Only assign levels to selected objects",
+        default=False
+    )
+
+    def execute(self, context):
+        camera = context.scene.camera
+        if camera is None:
+            self.report({'ERROR'}, "The scene has no active camera")
+            return {'CANCELLED'}
+
+        camera_location = camera.matrix_world.translation
+        # the height of the view at a distance of 1
+        view_size = 2.0 * math.tan(camera.data.angle / 2.0)
+
+        objects = context.scene.objects
+        if self.selection_only:
+            objects = context.selected_objects
+
+        changed = 0
+        for obj in objects:
+            if obj.type != "MESH" or strings.ldraw_lod_key not in obj.data:
+                continue
+
+            levels = obj.data[strings.ldraw_lod_key].to_dict()
+
+            center = obj.matrix_world @ (sum((mathutils.Vector(c) for c in obj.bound_box), mathutils.Vector()) / 8)
+            distance = (center - camera_location).length
+
+            level = "Standard"
+            if self.method == "distance":
+                if distance < self.high_distance:
+                    level = "High"
+                elif distance > self.low_distance:
+                    level = "Low"
+            else:
+                size = obj.dimensions.length / max(distance * view_size, 1e-6)
+                if size > self.high_size:
+                    level = "High"
+                elif size < self.low_size:
+                    level = "Low"
+
+            name = levels.get(level)
+            if name is None or name not in bpy.data.meshes:
+                continue
+
+            if obj.data.name != name:
+                swap_mesh(obj, bpy.data.meshes[name])
+                changed += 1
+
+        self.report({'INFO'}, f"Changed the level of {changed} objects")
+        return {'FINISHED'}
@@ -1,3 +1,5 @@
+from collections import namedtuple
+
 ldraw_path = ""
 meta_group = True
 meta_print_write = False
@@ -39,3 +41,57 @@ export_precision = 2
 recalculate_normals = True
 triangulate = False
 ngon_handling = "triangulate"
+use_parse_cache = False
+prefetch_threads = 0
+parse_processes = 0
+parse_cache_path = ""
+parse_cache_size = 256
+use_session_cache = False
+share_part_meshes = False
+instance_submodels = False
+instance_studs = False
+build_lods = False
+remove_hidden_faces = False
+merge_parts = "none"  # "collection" "model"
+merged_part_ids = True
+session_cache_size = 512
+
+
+# the options that change which files are found, what they flatten to and how their meshes are built
+# captured once at the start of an import and used as the first part of every cache key
+Fingerprint = namedtuple("Fingerprint", [
+    "ldraw_path",
+    "prefer_unofficial",
+    "resolution",
+    "chosen_logo",
+    "no_studs",
+    "remove_doubles",
+    "smooth_type",
+    "use_alt_colors",
+    "add_subsurface",
+    "instance_studs",
+])
+fingerprint = None
+
+
+def capture_fingerprint():
+    global fingerprint
+
+    logo = None
+    if display_logo:
+        logo = chosen_logo
+
+    fingerprint = Fingerprint(
+        ldraw_path=ldraw_path,
+        prefer_unofficial=prefer_unofficial,
+        resolution=resolution,
+        chosen_logo=logo,
+        no_studs=no_studs,
+        remove_doubles=remove_doubles,
+        smooth_type=smooth_type,
+        use_alt_colors=use_alt_colors,
+        add_subsurface=add_subsurface,
+        # the hide keyframes of steps are set per part object, which instanced studs don't have
+        instance_studs=instance_studs and not meta_step,
+    )
+    return fingerprint
@@ -0,0 +1,224 @@
+"""Stores parsed library files on disk so later imports can skip reading and parsing them.
+
+Each entry is one file: a fixed header, a json description of the file and its child references,
+then the raw geometry arrays. Entries are only used if the source file's path, mtime and size still match.
+Only used with options.use_parse_cache. Entries go in options.parse_cache_path, or a folder in the system temp folder.
+Reading an entry touches it, and once an import has parsed its files the least recently used entries are deleted
+until the cache takes up no more than options.parse_cache_size megabytes.
+"""
+
+import os
+import json
+import struct
+import hashlib
+import threading
+
+import numpy as np
+
+from . import options
+from . import filesystem
+from . import parse_worker
+
+magic = b"LDPC"
+version = 3
+header_struct = struct.Struct("<4sII")
+alignment = 16
+
+hits = 0
+misses = 0
+# entries are read by prefetch threads
+counter_lock = threading.Lock()
+
+
+def reset_caches():
+    global hits
+    global misses
+
+    hits = 0
+    misses = 0
+
+
+def __count(hit):
+    global hits
+    global misses
+
+    with counter_lock:
+        if hit:
+            hits += 1
+        else:
+            misses += 1
+
+
+def __align(offset):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def cache_path():
+    if options.parse_cache_path == "":
+        return filesystem.default_cache_path()
+    return options.parse_cache_path
+
+
+def cache_filepath(filepath):
+    key = hashlib.sha1(os.path.normcase(os.path.abspath(filepath)).encode("utf-8")).hexdigest()
+    return os.path.join(cache_path(), key[:2], f"{key}.ldpc")
+
+
+def save(ldraw_file, filepath):
+    entry = parse_worker.create_entry(ldraw_file.name, ldraw_file.part_type, ldraw_file.certified, ldraw_file.geometry, ldraw_file.child_references)
+    return write_entry(filepath, entry)
+
+
+def write_entry(filepath, entry):
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return False
+
+    arrays = entry["arrays"]
+
+    array_headers = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = __align(offset)
+        array_headers[name] = [array.dtype.str, list(array.shape), offset]
+        offset += array.nbytes
+
+    header = json.dumps({
+        "path": filepath,
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "name": entry["name"],
+        "part_type": entry["part_type"],
+        "certified": entry["certified"],
+        "children": [[r[0], r[2], r[3]] for r in entry["child_references"]],
+        "arrays": array_headers,
+    }).encode("utf-8")
+
+    data_start = __align(header_struct.size + len(header))
+
+    path = cache_filepath(filepath)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'wb') as file:
+            file.write(header_struct.pack(magic, version, len(header)))
+            file.write(header)
+            for name, array in arrays.items():
+                file.seek(data_start + array_headers[name][2])
+                file.write(array.tobytes())
+        os.replace(temp_path, path)
+    except OSError as e:
+        if options.debug_text:
+            print(f"could not write parse cache for {filepath}: {e}")
+        return False
+    return True
+
+
+# returns the cache entry of filepath, or None if there is none or it is out of date
+def read_entry(filepath):
+    path = cache_filepath(filepath)
+    try:
+        stat = os.stat(filepath)
+        buffer = filesystem.map_file(path)
+    except OSError:
+        __count(False)
+        return None
+
+    try:
+        entry_magic, entry_version, header_length = header_struct.unpack_from(buffer, 0)
+        if entry_magic != magic or entry_version != version:
+            __count(False)
+            return None
+
+        header = json.loads(bytes(buffer[header_struct.size:header_struct.size + header_length]).decode("utf-8"))
+        if header["path"] != filepath or header["mtime"] != stat.st_mtime_ns or header["size"] != stat.st_size:
+            __count(False)
+            return None
+
+        # the arrays are copied out, parsed files can be kept between imports and shouldn't keep the entry mapped
+        # on windows a mapped entry can't be replaced when its file changes
+        data_start = __align(header_struct.size + header_length)
+        arrays = {}
+        for name, (dtype, shape, offset) in header["arrays"].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            if count == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + offset).reshape(shape).copy()
+    except (struct.error, ValueError, KeyError) as e:
+        if options.debug_text:
+            print(f"bad parse cache entry for {filepath}: {e}")
+        __count(False)
+        return None
+
+    # the mtime of an entry is when it was last used, which is what prune goes by
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    child_matrices = arrays["child_matrices"].tolist()
+    child_references = [(color_code, tuple(matrix_values), filename, invert) for (color_code, filename, invert), matrix_values in zip(header["children"], child_matrices)]
+
+    __count(True)
+    return {
+        "name": header["name"],
+        "part_type": header["part_type"],
+        "certified": header["certified"],
+        "arrays": arrays,
+        "child_references": child_references,
+    }
+
+
+# fills ldraw_file from a cache entry
+def apply_entry(ldraw_file, entry):
+    arrays = entry["arrays"]
+
+    geometry = ldraw_file.geometry
+    geometry.vertices = arrays["vertices"]
+    geometry.faces = arrays["faces"]
+    geometry.face_color_codes = arrays["face_color_codes"]
+    geometry.face_use_edge_color = np.zeros(len(geometry.faces), dtype=bool)
+    geometry.face_grain_slope_allowed = np.ones(len(geometry.faces), dtype=bool)
+    geometry.edge_vertices = arrays["edge_vertices"]
+    geometry.edges = arrays["edges"]
+
+    ldraw_file.child_references = list(entry["child_references"])
+    ldraw_file.name = entry["name"]
+    ldraw_file.part_type = entry["part_type"]
+    ldraw_file.certified = entry["certified"]
+    ldraw_file.cached = True
+
+
+# deletes the least recently used entries until the cache takes up no more than options.parse_cache_size megabytes
+# run once an import has parsed its files, when nothing is writing entries anymore
+def prune():
+    entries = []
+    for directory, _, filenames in os.walk(cache_path()):
+        for filename in filenames:
+            if not filename.endswith(".ldpc"):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    max_size = options.parse_cache_size * 1024 * 1024
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+        removed += 1
+
+    if options.debug_text and removed > 0:
+        print(f"removed {removed} parse cache entries")
@@ -0,0 +1,125 @@
+"""Parses library files into the same payload as a parse cache entry.
+
+Only needs numpy, so it also runs outside of Blender. Worker processes import it through the addon package,
+which skips everything that needs bpy when bpy isn't there.
+Files that use anything besides the header, geometry lines and child references are left to LDrawFile.parse_file
+and come back as None.
+"""
+
+import os
+import sys
+import threading
+import multiprocessing.spawn
+import multiprocessing.context
+
+import numpy as np
+
+from . import helpers
+from . import filesystem
+from . import ldraw_part_types
+from .ldraw_geometry import LDrawGeometry
+
+# meta commands whose result depends on import options or that have side effects outside of the file
+# files that use any of these are never parsed here or put in the parse cache
+uncacheable_meta_commands = ["!colour", "step", "save", "clear", "print", "write", "!ldcad", "!leocad", "!texmap", "!:"]
+
+
+def create_entry(name, part_type, certified, geometry, child_references):
+    return {
+        "name": name,
+        "part_type": part_type,
+        "certified": certified,
+        "arrays": {
+            "vertices": np.ascontiguousarray(geometry.vertices, dtype=np.float64),
+            "faces": np.ascontiguousarray(geometry.faces, dtype=np.int32),
+            "face_color_codes": np.ascontiguousarray(geometry.face_color_codes, dtype=np.int32),
+            "edge_vertices": np.ascontiguousarray(geometry.edge_vertices, dtype=np.float64),
+            "edges": np.ascontiguousarray(geometry.edges, dtype=np.int32),
+            "child_matrices": np.array([r[1] for r in child_references], dtype=np.float64).reshape(-1, 12),
+        },
+        "child_references": child_references,
+    }
+
+
+# reads and parses the file at path in the worker, so only the path and the entry cross between processes
+# filepath is the name the file was referenced by
+def parse_file(filepath, path):
+    return parse_lines(filepath, filesystem.FileLines(filesystem.map_file(path)))
+
+
+# filepath is the name the file was referenced by
+def parse_lines(filepath, lines):
+    name = ""
+    part_type = None
+    certified = False
+    is_cw = False
+    invert_next = False
+    geometry = LDrawGeometry()
+    child_references = []
+
+    for line in lines:
+        params = helpers.parse_line(line, 15)
+
+        if params is None:
+            continue
+
+        if params[0] == "0":
+            command = params[1].lower()
+            if command in uncacheable_meta_commands:
+                return None
+            elif command in ["!ldraw_org"]:
+                if params[2].lower() in ["lcad"]:
+                    part_type = params[3].lower()
+                else:
+                    part_type = params[2].lower()
+            elif command == "name:":
+                name = line[7:].lower().strip()
+            elif command == "bfc":
+                certified, is_cw, invert_next = helpers.parse_bfc(params, certified, is_cw, invert_next)
+        elif params[0] == "1":
+            child_references.append(helpers.parse_child_reference(params, invert_next))
+            invert_next = False
+        elif params[0] in ["2"]:
+            geometry.parse_edge(params)
+            if part_type in ldraw_part_types.model_types:
+                part_type = "part"
+        elif params[0] in ["3", "4"]:
+            geometry.parse_face(params, is_cw)
+            if part_type in ldraw_part_types.model_types:
+                part_type = "part"
+
+    geometry.finalize()
+
+    if name == "":
+        name = os.path.basename(filepath)
+
+    return create_entry(name, part_type, certified, geometry, child_references)
+
+
+# before 2.91 sys.executable is the blender binary
+def python_executable():
+    bpy = sys.modules.get("bpy")
+    if bpy is not None:
+        return getattr(bpy.app, "binary_path_python", sys.executable)
+    return sys.executable
+
+
+# multiprocessing only has a process wide executable for spawned processes
+# it is swapped for the python executable just while a worker is started, so other users of multiprocessing keep theirs
+# spawned workers unpickle this class, which is why it lives here and not in prefetch
+class WorkerProcess(multiprocessing.context.SpawnProcess):
+    spawn_lock = threading.Lock()
+
+    @staticmethod
+    def _Popen(process_obj):
+        with WorkerProcess.spawn_lock:
+            executable = multiprocessing.spawn.get_executable()
+            multiprocessing.spawn.set_executable(python_executable())
+            try:
+                return multiprocessing.context.SpawnProcess._Popen(process_obj)
+            finally:
+                multiprocessing.spawn.set_executable(executable)
+
+
+class WorkerContext(multiprocessing.context.SpawnContext):
+    Process = WorkerProcess
@@ -0,0 +1,238 @@
+"""Reads referenced files ahead of the parser on a thread pool.
+
+As soon as a file is available it is parsed into the same payload as a parse cache entry and every file
+it references that hasn't been seen yet is queued. Workers locate the file and parse it, or read its parse cache entry,
+then queue that file's references in turn. The parser still runs depth first on the main thread and
+just applies the entries, so what gets imported doesn't change and no file is decoded twice.
+Files that parse_worker leaves to LDrawFile.parse_file only have their type 1 lines scanned.
+
+With parse_processes every file found this way is read and parsed in a worker process instead.
+The thread only hands the worker the path and moves on, the worker returns the same payload as a parse cache entry
+and the references in it are what get queued next. The parser applies the entry instead of parsing the file.
+"""
+
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+
+from . import options
+from . import helpers
+from . import filesystem
+from . import special_bricks
+from . import parse_cache
+from . import parse_worker
+from . import ldraw_file
+from . import ldraw_part_types
+
+executor = None
+process_pool = None
+futures = {}
+lock = threading.Lock()
+
+# filename => filenames it references, the dependency graph of the import
+dependencies = {}
+
+
+def reset_caches():
+    global dependencies
+
+    shutdown()
+    dependencies = {}
+
+
+def start():
+    global executor
+
+    thread_count = options.prefetch_threads
+    if options.parse_processes > 0:
+        # the threads are what find the files for the processes to parse
+        thread_count = max(thread_count, options.parse_processes)
+        __start_process_pool()
+
+    if thread_count > 0:
+        executor = ThreadPoolExecutor(max_workers=thread_count)
+
+
+# workers import parse_worker through the addon package, which they find on the copy of sys.path they are spawned with
+def __start_process_pool():
+    global process_pool
+
+    try:
+        process_pool = ProcessPoolExecutor(max_workers=options.parse_processes, mp_context=parse_worker.WorkerContext())
+    except (OSError, ValueError) as e:
+        print(f"could not start parse processes: {e}")
+        process_pool = None
+
+
+def shutdown():
+    global executor
+    global process_pool
+    global futures
+
+    # nothing new is queued once they are None, files still being parsed finish
+    with lock:
+        thread_executor = executor
+        worker_pool = process_pool
+        executor = None
+        process_pool = None
+
+    # threads may still be handing files to the process pool so they go first
+    if thread_executor is not None:
+        thread_executor.shutdown(wait=True)
+
+        if options.debug_text:
+            print(f"prefetched {len(futures)} files, {sum(len(d) for d in dependencies.values())} references")
+
+    if worker_pool is not None:
+        worker_pool.shutdown(wait=True)
+
+    # finished futures hold the lines they read, which can hold the mapping of a big file
+    futures = {}
+
+
+def __reference_filename(line):
+    params = helpers.parse_line(line, 15)
+    if params is None or params[0] != "1":
+        return None
+
+    filename = params[14].lower()
+    if filename == "":
+        return None
+
+    if options.display_logo:
+        if filename in special_bricks.studs:
+            filename = ldraw_file.get_logo_filename(filename)
+
+    return filename
+
+
+def discover(filepath, lines=None, child_references=None):
+    if executor is None:
+        return
+
+    with lock:
+        if filepath in dependencies:
+            return
+        dependencies[filepath] = []
+
+    filenames = []
+    if child_references is not None:
+        for color_code, matrix_values, filename, invert in child_references:
+            if options.display_logo and filename in special_bricks.studs:
+                filename = ldraw_file.get_logo_filename(filename)
+            filenames.append(filename)
+    elif lines is not None:
+        for line in lines:
+            if line.lstrip()[:1] != "1":
+                continue
+            filename = __reference_filename(line)
+            if filename is not None:
+                filenames.append(filename)
+
+    dependencies[filepath] = filenames
+
+    for filename in filenames:
+        with lock:
+            if filename in futures or executor is None:
+                continue
+            futures[filename] = executor.submit(__fetch, filename)
+
+
+# (parse cache entry, lines) of filename, or the future of the worker process parsing it
+def __fetch(filename):
+    mpd_file, path = ldraw_file.resolve_filepath(filename)
+    if mpd_file is None and path is None:
+        return None, None
+
+    if mpd_file is not None:
+        lines = mpd_file.lines
+    else:
+        if options.use_parse_cache:
+            entry = parse_cache.read_entry(path)
+            if entry is not None:
+                discover(filename, child_references=entry["child_references"])
+                return entry, None
+
+        with lock:
+            worker_pool = process_pool
+        if worker_pool is not None:
+            try:
+                future = worker_pool.submit(parse_worker.parse_file, filename, path)
+            except RuntimeError:
+                # shut down in the meantime
+                return None, None
+            future.add_done_callback(lambda f: __parsed(filename, path, f))
+            return future
+
+        lines = filesystem.read_file(path)
+
+    entry = __parse(filename, path, lines)
+    if entry is None:
+        return None, lines
+    return entry, None
+
+
+# the parse cache entry of a file the main thread has read, when anything is being prefetched
+# parsing it here lets its references be queued from the entry, which saves decoding the file again to find them
+def parse(filename, path, lines):
+    if executor is None:
+        return None
+    return __parse(filename, path, lines)
+
+
+# lines parsed into a parse cache entry whose references are queued, path is None for files embedded in an mpd
+# files parse_worker leaves to LDrawFile.parse_file have the references in their lines queued and give None
+def __parse(filename, path, lines):
+    entry = parse_worker.parse_lines(filename, lines)
+    if entry is None:
+        discover(filename, lines=lines)
+        return None
+
+    discover(filename, child_references=entry["child_references"])
+    if path is not None:
+        __save(path, entry)
+    return entry
+
+
+def __save(path, entry):
+    if options.use_parse_cache and entry["part_type"] not in ldraw_part_types.model_types:
+        parse_cache.write_entry(path, entry)
+
+
+# runs on the thread of the process pool that collects results, so anything that reads a file goes to the thread pool
+def __parsed(filename, path, future):
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    entry = future.result()
+    if entry is None:
+        with lock:
+            if executor is not None:
+                executor.submit(__discover_file, filename, path)
+        return
+
+    discover(filename, child_references=entry["child_references"])
+    __save(path, entry)
+
+
+# for files the worker leaves to LDrawFile.parse_file
+def __discover_file(filename, path):
+    discover(filename, lines=filesystem.read_file(path))
+
+
+# (parse cache entry, lines) of a prefetched file, (None, None) if it wasn't prefetched
+def get(filename):
+    with lock:
+        future = futures.get(filename)
+    if future is None:
+        return None, None
+
+    # let the main thread run into the same error again
+    try:
+        result = future.result()
+        if isinstance(result, Future):
+            return result.result(), None
+        return result
+    except Exception:
+        return None, None
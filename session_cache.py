@@ -0,0 +1,176 @@
+"""Keeps parsed library files and flattened part geometry in memory from one import to the next.
+
+Only used with options.use_session_cache. Entries are keyed by the same keys as the caches of a single import,
+which start with options.fingerprint, so switching options back and forth doesn't throw away what was built for the others.
+An entry is only used while every file it was built from is still found at the same path with the same
+mtime and size and isn't shadowed by a file embedded in the mpd being imported.
+Least recently used entries are dropped once the total goes over options.session_cache_size megabytes.
+"""
+
+import os
+from collections import OrderedDict
+
+from . import options
+from . import filesystem
+
+# rough size of an LDrawFile and of each of its child nodes besides its geometry arrays
+file_overhead = 1024
+node_overhead = 256
+
+# (kind, key) => (value, stamps, size) in least to most recently used order
+entries = OrderedDict()
+total_size = 0
+
+hits = 0
+misses = 0
+
+# for the current import
+mpd_filenames = set()
+file_stamps = {}
+valid_stamps = {}
+
+
+def reset_caches():
+    global hits
+    global misses
+    global mpd_filenames
+    global file_stamps
+    global valid_stamps
+
+    hits = 0
+    misses = 0
+    mpd_filenames = set()
+    file_stamps = {}
+    valid_stamps = {}
+
+    if not options.use_session_cache:
+        clear()
+
+
+def clear():
+    global entries
+    global total_size
+
+    entries = OrderedDict()
+    total_size = 0
+
+
+def get_file(key):
+    return __get("file", key)
+
+
+def put_file(key, ldraw_file):
+    stamps = __file_stamps(ldraw_file)
+    if stamps is None:
+        return
+    size = ldraw_file.geometry.nbytes() + file_overhead + node_overhead * len(ldraw_file.child_nodes)
+    __put("file", key, ldraw_file, stamps, size)
+
+
+def get_geometry(key):
+    return __get("geometry", key)
+
+
+# ldraw_file is the file geometry was flattened from
+def put_geometry(key, geometry, ldraw_file):
+    stamps = __file_stamps(ldraw_file)
+    if stamps is None:
+        return
+    __put("geometry", key, geometry, stamps, geometry.nbytes())
+
+
+def __get(kind, key):
+    global hits
+    global misses
+
+    if not options.use_session_cache:
+        return None
+
+    entry_key = (kind, key)
+    entry = entries.get(entry_key)
+    if entry is None:
+        misses += 1
+        return None
+
+    value, stamps, size = entry
+    for stamp in stamps:
+        if not __is_valid(stamp):
+            __remove(entry_key)
+            misses += 1
+            return None
+
+    entries.move_to_end(entry_key)
+    hits += 1
+    return value
+
+
+def __put(kind, key, value, stamps, size):
+    global total_size
+
+    if not options.use_session_cache:
+        return
+
+    max_size = options.session_cache_size * 1024 * 1024
+    if size > max_size:
+        return
+
+    entry_key = (kind, key)
+    __remove(entry_key)
+    entries[entry_key] = (value, stamps, size)
+    total_size += size
+
+    while total_size > max_size and len(entries) > 0:
+        __remove(next(iter(entries)))
+
+
+def __remove(entry_key):
+    global total_size
+
+    entry = entries.pop(entry_key, None)
+    if entry is not None:
+        total_size -= entry[2]
+
+
+# (filename, path, mtime, size) of ldraw_file and of every file below it
+# None if any of them came from an mpd, can't be kept or references a file that couldn't be found
+def __file_stamps(ldraw_file):
+    if ldraw_file in file_stamps:
+        return file_stamps[ldraw_file]
+
+    stamps = None
+    if ldraw_file.source_path is not None and ldraw_file.is_cacheable() and len(ldraw_file.child_nodes) == len(ldraw_file.child_references):
+        try:
+            stat = os.stat(ldraw_file.source_path)
+            stamps = {(ldraw_file.filepath, ldraw_file.source_path, stat.st_mtime_ns, stat.st_size)}
+        except OSError:
+            pass
+
+    if stamps is not None:
+        for child_node in ldraw_file.child_nodes:
+            child_stamps = __file_stamps(child_node.file)
+            if child_stamps is None:
+                stamps = None
+                break
+            stamps.update(child_stamps)
+
+    if stamps is not None:
+        stamps = frozenset(stamps)
+    file_stamps[ldraw_file] = stamps
+    return stamps
+
+
+def __is_valid(stamp):
+    if stamp in valid_stamps:
+        return valid_stamps[stamp]
+
+    filename, path, mtime, size = stamp
+    valid = False
+    if filename not in mpd_filenames and filesystem.locate(filename) == path:
+        try:
+            stat = os.stat(path)
+            valid = stat.st_mtime_ns == mtime and stat.st_size == size
+        except OSError:
+            pass
+
+    valid_stamps[stamp] = valid
+    return valid
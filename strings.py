@@ -1,5 +1,7 @@
 ldraw_edge_key = "ldraw_edge"
 ldraw_filename_key = "ldraw_filename"
 ldraw_color_code_key = "ldraw_color_code"
+ldraw_lod_key = "ldraw_lod"
+ldraw_part_key = "ldraw_part"
 ldraw_export_polygons_key = "ldraw_export_polygons"
 ldraw_export_precision_key = "ldraw_export_precision"
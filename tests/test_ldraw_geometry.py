@@ -0,0 +1,50 @@
+"""Runs with any python that has numpy, the modules under test don't import bpy.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+import importlib
+
+import numpy as np
+
+addon_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(addon_path))
+addon = importlib.import_module(os.path.basename(addon_path))
+parse_worker = importlib.import_module(f"{addon.__name__}.parse_worker")
+
+
+def face_normal(vertices):
+    v0, v1, v2, v3 = vertices
+    return np.cross(v2 - v0, v3 - v1)
+
+
+class ComplexQuadTest(unittest.TestCase):
+    # a bowtie, file order goes 0 0, 1 0, 0 1, 1 1
+    bowtie = "4 16 0 0 0 1 0 0 0 1 0 1 1 0"
+
+    def parse(self, bfc):
+        entry = parse_worker.parse_lines("bowtie.dat", ["0 BFC CERTIFY " + bfc, self.bowtie])
+        return entry["arrays"]["vertices"]
+
+    def test_ccw_complex_quad(self):
+        vertices = self.parse("CCW")
+        self.assertEqual(face_normal(vertices)[2], 2.0)
+        self.assertEqual(sorted(map(tuple, vertices)), [(0, 0, 0), (0, 1, 0), (1, 0, 0), (1, 1, 0)])
+
+    def test_cw_complex_quad(self):
+        vertices = self.parse("CW")
+        self.assertEqual(face_normal(vertices)[2], -2.0)
+        self.assertEqual(sorted(map(tuple, vertices)), [(0, 0, 0), (0, 1, 0), (1, 0, 0), (1, 1, 0)])
+
+    def test_cw_faces_are_reversed(self):
+        lines = ["0 BFC CERTIFY CW", "3 16 0 0 0 1 0 0 0 1 0", "4 16 0 0 0 1 0 0 1 1 0 0 1 0"]
+        vertices = parse_worker.parse_lines("cw.dat", lines)["arrays"]["vertices"]
+        np.testing.assert_array_equal(vertices[:3], [[0, 1, 0], [1, 0, 0], [0, 0, 0]])
+        np.testing.assert_array_equal(vertices[3:], [[0, 1, 0], [1, 1, 0], [1, 0, 0], [0, 0, 0]])
+
+
+if __name__ == "__main__":
+    unittest.main()